@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+# Benchmark for create_reference_column, timing the linking of consensus file names to runs at increasing input sizes.
+# Usage: python3 benchmarks/benchmark_reference_column.py [--sizes 1000 10000 100000 1000000]
+# Per-row time should stay roughly constant across sizes, showing linear scaling.
+
+import pandas as pd
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from create_metadata_spreadsheet import create_reference_column
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark create_reference_column at increasing input sizes')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help='Numbers of rows to benchmark with')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed repeats per size (best is kept)')
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_inputs(size):
+    """
+    Create synthetic list file contents resembling the script inputs
+    :param size: Number of rows to create
+    :return: Dictionary of final columns to the dataframe that would be read from the corresponding list file
+    """
+    runs = ['ERR{:08d}'.format(i) for i in range(size)]
+    return {
+        'FASTA': pd.DataFrame([run + '.fasta.gz' for run in runs]),
+        'ASSEMBLYNAME': pd.DataFrame([run + '_consensus' for run in runs]),
+        'CHROMOSOME_LIST': pd.DataFrame([run + '_consensus_chromosomelist.txt.gz' for run in runs]),
+    }
+
+
+if __name__ == '__main__':
+    args = get_args()
+    print('{:>10}  {:>15}  {:>12}  {:>12}'.format('rows', 'column', 'seconds', 'us/row'))
+    for size in args.sizes:
+        inputs = synthetic_inputs(size)
+        for column, df in inputs.items():
+            best = None
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                create_reference_column(df, [column, 'run_accession'])
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print('{:>10}  {:>15}  {:>12.4f}  {:>12.3f}'.format(size, column, best, best / size * 1e6))
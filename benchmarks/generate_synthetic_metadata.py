@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# Script to generate a synthetic SQLite database with the ERAPRO schema used by create_metadata_spreadsheet.py, along
+# with the list files it takes as input, so the whole pipeline can be run and load-tested locally.
+# Usage: python3 benchmarks/generate_synthetic_metadata.py -d synthetic.db -o synthetic --projects 10 --runs 100000
+# Then: python3 create_metadata_spreadsheet.py --sqlite_db synthetic.db -P synthetic/projects.txt \
+#           -n synthetic/names.txt -c synthetic/chromosome_lists.txt -f synthetic/fasta_files.txt
+
+import argparse, os, random, sqlite3, sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from create_metadata_spreadsheet import SQLiteBackend
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description='Generate a synthetic metadata database and input list files')
+    parser.add_argument('-d', '--database', type=str, help='SQLite database to create', required=True)
+    parser.add_argument('-o', '--output_dir', type=str, help='Directory to write the input list files to', required=True)
+    parser.add_argument('--projects', type=int, default=1, help='Number of projects (default: 1)')
+    parser.add_argument('--runs', type=int, default=10000, help='Number of runs per project (default: 10000)')
+    parser.add_argument('--submitted_fraction', type=float, default=1.0,
+                        help='Fraction of runs which have consensus files in the list files (default: 1.0)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for choosing the submitted runs (default: 0)')
+    args = parser.parse_args()
+    return args
+
+
+def generate_rows(num_projects, runs_per_project):
+    """
+    Generate the rows of every table, one experiment and sample per run and one study per project
+    :param num_projects: Number of projects
+    :param runs_per_project: Number of runs per project
+    :return: Generator of (project, study, experiment, sample, run, first created) tuples
+    """
+    start = datetime(2020, 3, 1)
+    index = 0
+    for p in range(num_projects):
+        project = 'PRJEB{:06d}'.format(p)
+        study = 'ERP{:06d}'.format(p)
+        for _ in range(runs_per_project):
+            first_created = (start + timedelta(seconds=index)).isoformat(timespec='seconds')
+            yield (project, study, 'ERX{:09d}'.format(index), 'ERS{:09d}'.format(index), 'ERR{:09d}'.format(index),
+                   first_created)
+            index += 1
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if os.path.exists(args.database):
+        sys.stderr.write("ERROR: Database {} already exists\n".format(args.database))
+        exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+    random.seed(args.seed)
+
+    connection = sqlite3.connect(args.database)
+    SQLiteBackend.create_schema(connection)
+    with connection:
+        connection.executemany("INSERT INTO project VALUES (?)",
+                               (('PRJEB{:06d}'.format(p),) for p in range(args.projects)))
+        connection.executemany("INSERT INTO study VALUES (?, ?)",
+                               (('ERP{:06d}'.format(p), 'PRJEB{:06d}'.format(p)) for p in range(args.projects)))
+
+    # Write the tables and the list files in a single pass over the generated runs
+    with open(os.path.join(args.output_dir, 'names.txt'), 'w') as names, \
+            open(os.path.join(args.output_dir, 'chromosome_lists.txt'), 'w') as chromosome_lists, \
+            open(os.path.join(args.output_dir, 'fasta_files.txt'), 'w') as fasta_files, connection:
+        batch = []
+        for row in generate_rows(args.projects, args.runs):
+            batch.append(row)
+            if random.random() < args.submitted_fraction:
+                run = row[4]
+                names.write(run + '_consensus\n')
+                chromosome_lists.write(run + '_consensus_chromosomelist.txt.gz\n')
+                fasta_files.write(run + '.fasta.gz\n')
+            if len(batch) == 100000:
+                connection.executemany("INSERT INTO experiment VALUES (?, ?)", ((r[2], r[1]) for r in batch))
+                connection.executemany("INSERT INTO sample VALUES (?)", ((r[3],) for r in batch))
+                connection.executemany("INSERT INTO experiment_sample VALUES (?, ?)", ((r[2], r[3]) for r in batch))
+                connection.executemany("INSERT INTO run VALUES (?, ?, ?)", ((r[4], r[2], r[5]) for r in batch))
+                batch = []
+        connection.executemany("INSERT INTO experiment VALUES (?, ?)", ((r[2], r[1]) for r in batch))
+        connection.executemany("INSERT INTO sample VALUES (?)", ((r[3],) for r in batch))
+        connection.executemany("INSERT INTO experiment_sample VALUES (?, ?)", ((r[2], r[3]) for r in batch))
+        connection.executemany("INSERT INTO run VALUES (?, ?, ?)", ((r[4], r[2], r[5]) for r in batch))
+    connection.close()
+
+    with open(os.path.join(args.output_dir, 'projects.txt'), 'w') as f:
+        f.writelines('PRJEB{:06d}\n'.format(p) for p in range(args.projects))
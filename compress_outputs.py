@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# Script to gzip the files produced for submission (chromosome list files, per-run consensus FASTA) in parallel.
+# Compression runs in a thread pool, as zlib releases the GIL while compressing, so all cores are used instead of the
+# single core used by a serial gzip invocation.
+
+import argparse, gzip, os, shutil, sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  compress_outputs.py                                                  |
+        |  Tool which gzips chromosome list files and consensus FASTA files     |
+        |  in parallel, replacing each file with <file>.gz.                     |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('files', type=str, nargs='*', help='Files to compress')
+    parser.add_argument('-i', '--input_list', type=str,
+                        help='Files to compress, avoiding long command lines. Format: List of file paths - one per line')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of files compressed at the same time (default: number of CPUs)')
+    parser.add_argument('-l', '--compresslevel', type=int, default=6, help='Gzip compression level (default: 6)')
+    parser.add_argument('-k', '--keep', action='store_true', help='Keep the uncompressed files')
+    args = parser.parse_args()
+    if not args.files and not args.input_list:
+        parser.error('no files to compress, provide files or -i/--input_list')
+    return args
+
+
+def parallel_map(function, items, workers, max_pending=None):
+    """
+    Apply a function to each item in a thread pool, yielding results in the order of the items. At most max_pending
+    items are submitted ahead of the results consumed, so memory stays bounded for any number of items
+    :param function: Function to apply to each item
+    :param items: Iterable of items
+    :param workers: Number of threads
+    :param max_pending: Maximum number of items submitted but not yet consumed (default: 4 per thread)
+    :return: Generator of results
+    """
+    max_pending = max_pending or 4 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def compress_file(path, compresslevel=6, keep=False):
+    """
+    Gzip a file to <path>.gz, writing through a temporary file so an interrupted run never leaves a truncated .gz
+    :param path: Path to the file to compress
+    :param compresslevel: Gzip compression level
+    :param keep: Whether to keep the uncompressed file
+    :return: Path to the compressed file
+    """
+    compressed = path + '.gz'
+    temporary = compressed + '.tmp'
+    with open(path, 'rb') as source, open(temporary, 'wb') as target:
+        with gzip.GzipFile(filename=os.path.basename(path), mode='wb', compresslevel=compresslevel,
+                           fileobj=target, mtime=0) as gz:
+            shutil.copyfileobj(source, gz, length=1024 * 1024)
+    os.replace(temporary, compressed)
+    if not keep:
+        os.remove(path)
+    return compressed
+
+
+def compress_files(paths, workers=None, compresslevel=6, keep=False):
+    """
+    Gzip files in parallel
+    :param paths: Iterable of paths to the files to compress
+    :param workers: Number of files compressed at the same time (default: number of CPUs)
+    :param compresslevel: Gzip compression level
+    :param keep: Whether to keep the uncompressed files
+    :return: Generator of paths to the compressed files, in the order of the paths given
+    """
+    return parallel_map(lambda path: compress_file(path, compresslevel, keep), paths, workers or os.cpu_count())
+
+
+def read_paths(args):
+    """
+    Stream the paths of the files to compress from the arguments
+    :param args: Arguments passed to the script
+    :return: Generator of file paths
+    """
+    yield from args.files
+    if args.input_list:
+        with open(args.input_list) as f:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    count = 0
+    for compressed in compress_files(read_paths(args), args.workers, args.compresslevel, args.keep):
+        count += 1
+    sys.stdout.write("number of files compressed: {}\n".format(count))
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+# Script to compute the mean coverage of each run from its depth file, to fill the COVERAGE column of the metadata
+# spreadsheet. Supports `samtools depth` output (chrom, pos, depth) and mosdepth per-base/bedGraph output
+# (chrom, start, end, depth), optionally gzipped. Use `samtools depth -a` so positions with zero depth are included.
+# Files are read in chunks and summed with NumPy, in parallel across runs, and results are cached by file mtime.
+
+import argparse, json, os, sys, threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from fasta_utils import discover_files
+
+DEPTH_PATTERNS = ['*.depth', '*.depth.txt', '*.depth.gz', '*.depth.txt.gz', '*.per-base.bed.gz',
+                  '*.bedgraph', '*.bedgraph.gz']  # Default glob patterns of depth file names
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  compute_coverage.py                                                  |
+        |  Tool which computes the mean coverage of each run from samtools      |
+        |  depth or mosdepth output.                                            |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-d', '--depth_dir', type=str, required=True,
+                        help='Directory of depth files, named <run>.* (e.g. ERR4080473.depth.txt)')
+    parser.add_argument('--depth_pattern', type=str, action='append',
+                        help='Glob pattern matching depth file names, can be repeated (default: common samtools depth and mosdepth names)')
+    parser.add_argument('-o', '--output', type=str, default='coverage.txt',
+                        help='File to write the coverage of each run to (default: coverage.txt)')
+    parser.add_argument('--cache', type=str,
+                        help='Cache of computed coverage, reused while depth files are unchanged (default: .coverage_cache.json in the depth directory)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of depth files read at the same time (default: number of CPUs)')
+    args = parser.parse_args()
+    return args
+
+
+def mean_depth(path, chunksize=1000000):
+    """
+    Compute the mean depth of a depth file, streaming it in chunks
+    :param path: Path to the depth file, gzipped if ending in .gz
+    :param chunksize: Number of lines read at a time
+    :return: Mean depth over the positions covered by the file, None if the file is empty
+    """
+    total_depth, total_length = 0, 0
+    try:
+        chunks = pd.read_csv(path, sep="\t", header=None, comment='#', chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        return None
+    for chunk in chunks:
+        values = chunk.to_numpy()
+        if values.shape[1] >= 4:  # mosdepth/bedGraph intervals: chrom, start, end, depth
+            lengths = values[:, 2].astype(np.int64) - values[:, 1].astype(np.int64)
+            total_depth += float(np.dot(lengths, values[:, 3].astype(np.float64)))
+            total_length += int(lengths.sum())
+        else:  # samtools depth positions: chrom, pos, depth
+            total_depth += float(values[:, 2].astype(np.float64).sum())
+            total_length += len(values)
+    return total_depth / total_length if total_length else 0.0
+
+
+def load_cache(path):
+    """
+    Load the coverage cache
+    :param path: Path to the cache file
+    :return: Dictionary of depth file path to its modification time, size and coverage
+    """
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_cache(cache, path):
+    """
+    Save the coverage cache, through a temporary file so an interrupted run never leaves it truncated
+    :param cache: Dictionary of depth file path to its modification time, size and coverage
+    :param path: Path to the cache file
+    """
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())  # Unique to this writer
+    with open(temporary, 'w') as f:
+        json.dump(cache, f)
+    os.replace(temporary, path)
+
+
+def compute_coverage(depth_paths, workers=None, cache_path=None):
+    """
+    Compute the mean coverage of each run from its depth file, reading only files changed since they were cached
+    :param depth_paths: Paths to the depth files, named <run>.*
+    :param workers: Number of depth files read at the same time (default: number of CPUs)
+    :param cache_path: Path to the coverage cache, None to not cache
+    :return: Dataframe of run_accession and COVERAGE, one row per run
+    """
+    paths_by_run = {}
+    for path in sorted(depth_paths):
+        paths_by_run.setdefault(os.path.basename(path).split('.')[0], []).append(path)
+    depth_paths = []
+    for run, paths in paths_by_run.items():
+        if len(paths) > 1:  # e.g. both <run>.depth and <run>.depth.txt match the default patterns
+            sys.stderr.write("WARNING: Run {} has {} depth files, using {} and ignoring {}\n".format(
+                run, len(paths), paths[0], ', '.join(paths[1:])))
+        depth_paths.append(paths[0])
+
+    cache = load_cache(cache_path)
+    keys = {path: os.path.abspath(path) for path in depth_paths}  # Cache keys, independent of the working directory
+    stats = {path: os.stat(path) for path in depth_paths}
+    stale = [path for path, stat in stats.items() if keys[path] not in cache
+             or cache[keys[path]]['mtime'] != stat.st_mtime or cache[keys[path]]['size'] != stat.st_size]
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            for path, coverage in zip(stale, executor.map(mean_depth, stale)):
+                cache[keys[path]] = {'mtime': stats[path].st_mtime, 'size': stats[path].st_size, 'coverage': coverage}
+        if cache_path:
+            save_cache(cache, cache_path)
+    rows = []
+    for path in depth_paths:
+        coverage = cache[keys[path]]['coverage']
+        if coverage is None:
+            sys.stderr.write("WARNING: Depth file {} is empty, its run has no coverage computed\n".format(path))
+            continue
+        rows.append((os.path.basename(path).split('.')[0], round(coverage, 2)))
+    return pd.DataFrame(rows, columns=['run_accession', 'COVERAGE'])
+
+
+if __name__ == '__main__':
+    args = get_args()
+    depth_paths = discover_files(args.depth_dir, args.depth_pattern or DEPTH_PATTERNS, args.workers)
+    coverage = compute_coverage(depth_paths, args.workers,
+                                args.cache or os.path.join(args.depth_dir, '.coverage_cache.json'))
+    coverage.to_csv(args.output, sep="\t", index=False)
+    print("number of runs with coverage computed: {}".format(len(coverage)))
@@ -12,9 +12,25 @@
 # Note for Mac: Workaround for security issues --> http://oraontap.blogspot.com/2020/01/mac-os-x-catalina-and-oracle-instant.html#:~:text=Developer%20Cannot%20be%20Verified&text=You%20can%20go%20to%20the,also%20has%20to%20be%20approved.
 
 # Oracle Client EXAMPLE = '/Users/rahman/Downloads/instantclient_19_3'
+import numpy as np
 import pandas as pd
-import argparse, cx_Oracle, os, sys
+import argparse, json, os, sqlite3, sys, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from getpass import getpass
+from compress_outputs import parallel_map
+from compute_coverage import DEPTH_PATTERNS, compute_coverage
+from fasta_utils import FASTA_EXTENSIONS, discover_files, run_accession, scan_headers, sequence_name
+from generate_chromlistfile import write_chromosome_list
+from sequence_qc import failed_runs, qc_passed, run_qc
+from sharding import SHARD_KEYS, in_shard, parse_shard, paths_in_shard, shard_count, shard_filename, write_shards
+from submission_state import SubmissionState
+from write_manifests import write_manifests
+
+try:
+    import cx_Oracle
+except ImportError:
+    cx_Oracle = None  # Only required when obtaining metadata from ERAPRO rather than a SQLite stand-in
 
 
 def get_args():
@@ -29,66 +45,634 @@ def get_args():
         |  validation/submission.                                               |
         + ===================================================================== +
         """, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-p', '--project', type=str, help='Project ID to obtain metadata for', required=True)
+    parser.add_argument('-p', '--project', type=str, action='append', default=[],
+                        help='Project ID to obtain metadata for. Can be repeated to process several projects in one batch')
+    parser.add_argument('-P', '--projects_file', type=str,
+                        help='Project IDs to obtain metadata for. Format: List of project IDs - one per line')
     parser.add_argument('-n', '--names', type=str,
-                        help='Consensus/assembled sequence header names to be included as assembly names. Format: List of consensus/assembled sequence headers - one per line',
-                        required=True)
+                        help='Consensus/assembled sequence header names to be included as assembly names. Format: List of consensus/assembled sequence headers - one per line')
     parser.add_argument('-c', '--chromosome_list', type=str,
-                        help='Chromosome list files created to be used in submission. Format: List of names of chromosome list files - one per line',
-                        required=True)
+                        help='Chromosome list files created to be used in submission. Format: List of names of chromosome list files - one per line')
     parser.add_argument('-f', '--fasta_files', type=str,
-                        help='Fasta files of assembled/consensus sequence to be submitted. Format: List of names of fasta files - one per line',
-                        required=True)
+                        help='Fasta files of assembled/consensus sequence to be submitted. Format: List of names of fasta files - one per line, or with --from_fasta_headers a directory of fasta files')
+    parser.add_argument('--fasta_dir', '--fasta-dir', type=str,
+                        help='Directory to discover the fasta files to be submitted in, instead of -f/--fasta_files')
+    parser.add_argument('--chromlist_dir', '--chromlist-dir', type=str,
+                        help='Directory to discover the chromosome list files to be submitted in, instead of -c/--chromosome_list')
+    parser.add_argument('--fasta_pattern', type=str, action='append',
+                        help='Glob pattern matching fasta file names in --fasta_dir, can be repeated (default: common fasta extensions, optionally gzipped)')
+    parser.add_argument('--chromlist_pattern', type=str, action='append',
+                        help='Glob pattern matching chromosome list file names in --chromlist_dir, can be repeated (default: *_chromosomelist.txt.gz)')
+    parser.add_argument('--from_fasta_headers', action='store_true',
+                        help='Derive assembly names and chromosome list files from the headers of the fasta files, instead of -n/--names and -c/--chromosome_list')
+    parser.add_argument('--chromosome_list_dir', type=str, default='.',
+                        help='Directory to write chromosome list files to with --from_fasta_headers (default: current directory)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of fasta files scanned at the same time with --from_fasta_headers (default: number of CPUs)')
+    parser.add_argument('--arraysize', type=int, default=5000,
+                        help='Number of rows fetched from the database per round-trip, also the size of each streamed chunk (default: 5000)')
+    parser.add_argument('--prefetchrows', type=int, default=5000,
+                        help='Number of rows prefetched by the Oracle client when the query is executed (default: 5000)')
+    parser.add_argument('--sqlite_db', type=str,
+                        help='SQLite database with the ERAPRO schema to obtain metadata from instead of ERAPRO (e.g. created by benchmarks/generate_synthetic_metadata.py)')
+    parser.add_argument('--depth_dir', type=str,
+                        help='Directory of per-run samtools depth or mosdepth files, named <run>.*, to compute the COVERAGE column from instead of the preset value')
+    parser.add_argument('--depth_pattern', type=str, action='append',
+                        help='Glob pattern matching depth file names in --depth_dir, can be repeated (default: common samtools depth and mosdepth names)')
+    parser.add_argument('--qc_report', type=str,
+                        help='Check the consensus sequences before submission, writing a QC report (one row per sequence) to this file and leaving out runs which fail')
+    parser.add_argument('--min_length', type=int, default=0,
+                        help='Minimum sequence length to pass QC with --qc_report (default: 0)')
+    parser.add_argument('--max_n_fraction', type=float, default=1.0,
+                        help='Maximum fraction of N in a sequence to pass QC with --qc_report (default: 1.0)')
+    parser.add_argument('--dsn', type=str,
+                        help='Oracle data source name to connect to instead of ERAPRO (e.g. a TNS alias held in an Oracle wallet)')
+    parser.add_argument('--credentials_file', type=str,
+                        help='File of database credentials, used if $ORACLE_USERNAME and $ORACLE_PASSWORD are not set. Format: username=<USERNAME> and password=<PASSWORD> lines')
+    parser.add_argument('--external_auth', action='store_true',
+                        help='Authenticate to the database externally, e.g. with an Oracle wallet, instead of with a username and password')
+    parser.add_argument('--cache', type=str,
+                        help='SQLite file used as a local cache of project metadata, created if it does not exist')
+    parser.add_argument('--cache_ttl', type=int, default=3600,
+                        help='Number of seconds cached project metadata is used for before it is refreshed (default: 3600)')
+    parser.add_argument('--cache_only', '--cache-only', action='store_true',
+                        help='Use only the cached project metadata and do not connect to the database')
+    parser.add_argument('--shards', type=int,
+                        help='Split the metadata of each project into this number of balanced shards, each with a header, plus a shard index file')
+    parser.add_argument('--rows_per_shard', '--rows-per-shard', type=int,
+                        help='Split the metadata of each project into balanced shards of at most about this number of rows instead')
+    parser.add_argument('--shard_by', type=str, choices=sorted(SHARD_KEYS), default='run',
+                        help='Shard by hash of the run accession, or of the sample accession keeping the runs of a sample together (default: run)')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='Only process the runs of shard i of N, assigned by a stable hash of the run accession, e.g. $SLURM_ARRAY_TASK_ID/N for array tasks 1-N. Format: i/N')
+    parser.add_argument('--manifest_dir', type=str,
+                        help='Also write a Webin-CLI manifest per run to this directory, straight from the merged metadata')
+    parser.add_argument('--state_db', type=str,
+                        help='SQLite submission state database, so that runs already submitted are left out and only the delta is processed')
 
     args = parser.parse_args()
+    if not args.project and not args.projects_file:
+        parser.error('at least one of -p/--project or -P/--projects_file is required')
+    if not args.fasta_files and not args.fasta_dir:
+        parser.error('one of -f/--fasta_files or --fasta_dir is required')
+    if not args.from_fasta_headers and not (args.names and (args.chromosome_list or args.chromlist_dir)):
+        parser.error('-n/--names and -c/--chromosome_list (or --chromlist_dir) are required unless --from_fasta_headers is used')
+    if args.shards and args.rows_per_shard:
+        parser.error('only one of --shards and --rows_per_shard can be used')
+    if args.shard and (args.shards or args.rows_per_shard):
+        parser.error('--shard cannot be used with --shards or --rows_per_shard')
+    if (args.shards is not None and args.shards < 1) or (args.rows_per_shard is not None and args.rows_per_shard < 1):
+        parser.error('--shards and --rows_per_shard must be at least 1')
+    args.fasta_pattern = args.fasta_pattern or ['*' + extension for extension in FASTA_EXTENSIONS]
+    args.chromlist_pattern = args.chromlist_pattern or ['*_chromosomelist.txt.gz']
+    if args.cache_only and not args.cache:
+        parser.error('--cache_only requires --cache')
     return args
 
 
-class MetadataFromDatabase:
-    # Class object which handles obtaining metadata from ERAPRO database
-    def __init__(self, project, sql_query):
-        self.project = project  # Project ID
-        self.query = sql_query  # SQL query to obtain metadata
+def get_projects(args):
+    """
+    Collect the project IDs to be processed from the arguments, in order and without duplicates
+    :param args: Arguments passed to the script
+    :return: List of project IDs
+    """
+    projects = list(args.project)
+    if args.projects_file:
+        with open(args.projects_file) as f:
+            projects.extend(line.strip() for line in f if line.strip())
+    return list(dict.fromkeys(projects))
 
-    def get_oracle_usr_pwd(self):
+
+METADATA_COLUMNS = ['study_accession', 'sample_accession', 'run_accession']  # Columns of the metadata obtained from the database
+PRESET_PARAMETERS = {'ASSEMBLY_TYPE': 'COVID-19 outbreak', 'COVERAGE': 30, 'PROGRAM': 'Minimap2',
+                     'PLATFORM': 'OXFORD_NANOPORE', 'MINGAPLENGTH': 1,
+                     'MOLECULETYPE': 'genomic DNA'}  # Values shared by every assembly in the spreadsheet
+
+
+class MetadataCache:
+    # Class object which handles a local SQLite cache of project metadata. Each project records the database time of its
+    # last snapshot, so a refresh only needs to obtain the runs created since then
+    def __init__(self, path, ttl=3600):
+        self.path = path  # Path to the SQLite cache file
+        self.ttl = ttl  # Number of seconds a snapshot is used for before it is refreshed
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshot (
+                project_id TEXT PRIMARY KEY,
+                refreshed_at TEXT NOT NULL,
+                checked_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS metadata (
+                project_id TEXT NOT NULL,
+                sample_id TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                PRIMARY KEY (project_id, run_id, sample_id));
+            """)
+
+    def snapshots(self, projects):
         """
-        Obtain credentials to create an SQL connection
-        :return: Username and password for a valid SQL database account
+        Obtain the snapshot of each cached project
+        :param projects: Project IDs to look up
+        :return: Dictionary of project ID to the database time of its snapshot and the local time it was last checked
         """
-        self.usr = input("Username: ")  # Ask for username
-        self.pwd = getpass()  # Ask for password and handle appropriately
+        placeholders = ','.join('?' * len(projects))
+        rows = self.connection.execute(
+            "SELECT project_id, refreshed_at, checked_at FROM snapshot WHERE project_id IN ({})".format(placeholders),
+            list(projects))
+        return {project: (datetime.fromisoformat(refreshed_at), checked_at) for project, refreshed_at, checked_at in rows}
 
-    def setup_connection(self):
+    def stale_projects(self, projects):
         """
-        Set up the database connection
-        :return: Database connection object
+        Obtain the projects which are not cached, or whose snapshot is older than the time to live
+        :param projects: Project IDs to check
+        :return: List of project IDs to be refreshed
+        """
+        snapshots = self.snapshots(projects)
+        now = time.time()
+        return [project for project in projects if project not in snapshots or now - snapshots[project][1] > self.ttl]
+
+    def store(self, chunks, projects, refreshed_at):
+        """
+        Add metadata to the cache and record the snapshot of the projects it was obtained for
+        :param chunks: Iterable of dataframes of metadata, as obtained from the database
+        :param projects: Project IDs the metadata was obtained for
+        :param refreshed_at: Database time at which the metadata was obtained
+        """
+        with self.connection:
+            for chunk in chunks:
+                self.connection.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?, ?)",
+                                            chunk[METADATA_COLUMNS].itertuples(index=False, name=None))
+            self.connection.executemany("INSERT OR REPLACE INTO snapshot VALUES (?, ?, ?)",
+                                        [(project, refreshed_at.isoformat(), time.time()) for project in projects])
+
+    def read(self, projects, runs=None):
+        """
+        Obtain cached metadata
+        :param projects: Project IDs to obtain metadata for
+        :param runs: Run IDs to restrict the metadata to, None for all runs
+        :return: Dataframe of metadata
+        """
+        placeholders = ','.join('?' * len(projects))
+        df = pd.read_sql_query(
+            "SELECT project_id, sample_id, run_id FROM metadata WHERE project_id IN ({})".format(placeholders),
+            self.connection, params=list(projects))
+        df.columns = METADATA_COLUMNS
+        if runs is not None:
+            df = df[df['run_accession'].isin(runs)].reset_index(drop=True)
+        return df
+
+    def close(self):
+        """
+        Close the cache
         """
+        self.connection.close()
+
+
+class OracleSessionPool:
+    # Class object which holds the session pool shared by every MetadataFromDatabase object in the process, so the Oracle
+    # client is initialised once and warm sessions are reused across fetches rather than connecting for each one
+    client_initialised = False  # Whether the Oracle client libraries have been initialised in this process
+    pool = None  # Session pool, created on first use
+
+    @classmethod
+    def init_oracle_client(cls):
+        """
+        Initialise the Oracle client libraries, doing nothing if they have already been initialised
+        """
+        if cls.client_initialised:
+            return
+        if cx_Oracle is None:
+            sys.stderr.write("ERROR: cx_Oracle must be installed to obtain metadata from ERAPRO\n")
+            exit(1)
         client_lib_dir = os.getenv('ORACLE_CLIENT_LIB')
         if not client_lib_dir or not os.path.isdir(client_lib_dir):
             sys.stderr.write("ERROR: Environment variable $ORACLE_CLIENT_LIB must point at a valid directory\n")
             exit(1)
         cx_Oracle.init_oracle_client(lib_dir=client_lib_dir)
+        cls.client_initialised = True
+
+    @classmethod
+    def get_pool(cls, usr, pwd, pool_min=1, pool_max=4, pool_increment=1, stmtcachesize=20, dsn=None,
+                 external_auth=False):
+        """
+        Obtain the shared session pool, creating it with the given credentials and sizes if it does not exist yet
+        :param usr: Username for a valid SQL database account, unused with external authentication
+        :param pwd: Password for a valid SQL database account, unused with external authentication
+        :param pool_min: Number of sessions opened when the pool is created
+        :param pool_max: Maximum number of sessions in the pool
+        :param pool_increment: Number of sessions opened whenever the pool needs to grow
+        :param stmtcachesize: Number of parsed statements kept in the statement cache of each session
+        :param dsn: Data source name to connect to, defaults to ERAPRO
+        :param external_auth: Whether to authenticate externally (e.g. with an Oracle wallet) rather than with credentials
+        :return: Session pool object
+        """
+        if cls.pool is None:
+            cls.init_oracle_client()
+            if dsn is None:
+                dsn = cx_Oracle.makedsn("ora-vm-009.ebi.ac.uk", 1541,
+                                        service_name="ERAPRO")  # Pool connections to ERAPRO with credentials
+            if external_auth:
+                cls.pool = cx_Oracle.SessionPool(dsn=dsn, min=pool_min, max=pool_max, increment=pool_increment,
+                                                 threaded=True, getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+                                                 externalauth=True, homogeneous=False, encoding="UTF-8")
+            else:
+                cls.pool = cx_Oracle.SessionPool(user=usr, password=pwd, dsn=dsn, min=pool_min, max=pool_max,
+                                                 increment=pool_increment, threaded=True,
+                                                 getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT, encoding="UTF-8")
+            cls.pool.stmtcachesize = stmtcachesize
+        return cls.pool
+
+    @classmethod
+    def close(cls):
+        """
+        Close the shared session pool
+        """
+        if cls.pool is not None:
+            cls.pool.close()
+            cls.pool = None
+
+
+class OracleBackend:
+    # Class object which handles connections to the ERAPRO Oracle database. Sessions are acquired from the shared
+    # OracleSessionPool and lists of IDs are bound as a single collection through TABLE()
+    list_expression = "SELECT column_value FROM TABLE(:{})"  # Selects the elements of a bound list of IDs
+    current_time_query = "SELECT SYSDATE FROM dual"  # Obtains the current database time
+    list_type = 'SYS.ODCIVARCHAR2LIST'  # Oracle collection type lists of IDs are bound as
+    max_collection_size = 32767  # Maximum number of elements in a single bound collection of that type
+
+    def __init__(self, stmtcachesize=20, pool_min=1, pool_max=4, pool_increment=1, dsn=None, credentials_file=None,
+                 external_auth=False):
+        self.stmtcachesize = stmtcachesize  # Number of parsed statements kept in the statement cache of each session
+        self.pool_min = pool_min  # Number of sessions opened when the shared pool is created
+        self.pool_max = pool_max  # Maximum number of sessions in the shared pool
+        self.pool_increment = pool_increment  # Number of sessions opened whenever the shared pool needs to grow
+        self.dsn = dsn  # Data source name to connect to, None for ERAPRO
+        self.credentials_file = credentials_file  # File holding the username and password, None to not use one
+        self.external_auth = external_auth  # Whether to authenticate externally (e.g. with an Oracle wallet)
+        self.usr = self.pwd = None  # Credentials, only requested if the shared pool has not been created yet
+        self.connection = None  # Database connection acquired from the shared pool
+
+    def get_oracle_usr_pwd(self):
+        """
+        Obtain credentials to create an SQL connection. These are taken from the environment variables $ORACLE_USERNAME
+        and $ORACLE_PASSWORD, otherwise the credentials file, otherwise the script operator is asked if running in a
+        terminal, so unattended jobs never block on a prompt
+        :return: Username and password for a valid SQL database account
+        """
+        usr, pwd = os.getenv('ORACLE_USERNAME'), os.getenv('ORACLE_PASSWORD')
+        if usr and pwd:
+            self.usr, self.pwd = usr, pwd
+        elif self.credentials_file:
+            self.usr, self.pwd = self.read_credentials_file(self.credentials_file)
+        elif sys.stdin.isatty():
+            self.usr = input("Username: ")  # Ask for username
+            self.pwd = getpass()  # Ask for password and handle appropriately
+        else:
+            sys.stderr.write("ERROR: No database credentials available. Set $ORACLE_USERNAME and $ORACLE_PASSWORD, "
+                             "provide a credentials file or use external authentication\n")
+            exit(1)
+
+    @staticmethod
+    def read_credentials_file(path):
+        """
+        Read credentials from a file of 'username=<USERNAME>' and 'password=<PASSWORD>' lines
+        :param path: Path to the credentials file
+        :return: Username and password
+        """
+        if os.stat(path).st_mode & 0o077:
+            sys.stderr.write("WARNING: Credentials file {} is readable by other users\n".format(path))
+        credentials = {}
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    key, value = line.split('=', 1)
+                    credentials[key.strip().lower()] = value.strip()
+        if 'username' not in credentials or 'password' not in credentials:
+            sys.stderr.write("ERROR: Credentials file {} must contain username and password lines\n".format(path))
+            exit(1)
+        return credentials['username'], credentials['password']
+
+    def setup_connection(self):
+        """
+        Set up the database connection by acquiring a session from the shared pool
+        :return: Database connection object
+        """
+        if OracleSessionPool.pool is None:
+            OracleSessionPool.init_oracle_client()
+            if not self.external_auth:
+                self.get_oracle_usr_pwd()  # Obtain credentials, only needed to create the pool
         self.connection = None
         try:
-            dsn = cx_Oracle.makedsn("ora-vm-009.ebi.ac.uk", 1541,
-                                    service_name="ERAPRO")  # Try connection to ERAPRO with credentials
-            self.connection = cx_Oracle.connect(self.usr, self.pwd, dsn, encoding="UTF-8")
+            pool = OracleSessionPool.get_pool(self.usr, self.pwd, self.pool_min, self.pool_max, self.pool_increment,
+                                              self.stmtcachesize, self.dsn, self.external_auth)
+            self.connection = pool.acquire()
         except cx_Oracle.Error as error:
             print(error)
+        return self.connection
+
+    def cursor(self, arraysize, prefetchrows):
+        """
+        Create a cursor on the database connection
+        :param arraysize: Number of rows fetched per round-trip
+        :param prefetchrows: Number of rows returned along with the execute call
+        :return: Database cursor
+        """
+        cursor = self.connection.cursor()
+        cursor.arraysize = arraysize
+        cursor.prefetchrows = prefetchrows
+        return cursor
+
+    def bind_list(self, values):
+        """
+        Convert a list of IDs to the value bound for list_expression
+        :param values: List of IDs
+        :return: Oracle collection of the IDs
+        """
+        return self.connection.gettype(self.list_type).newobject(list(values))
+
+    def bind_time(self, value):
+        """
+        Convert a time to the value bound when comparing with the creation time of runs
+        :param value: Datetime object
+        :return: Datetime object, bound as an Oracle DATE
+        """
+        return value
+
+    def current_time(self, cursor):
+        """
+        Obtain the current database time
+        :param cursor: Database cursor
+        :return: Datetime object
+        """
+        cursor.execute(self.current_time_query)
+        return cursor.fetchone()[0]
+
+    def close(self):
+        """
+        Release the database connection back to the shared pool
+        """
+        if self.connection is not None:
+            OracleSessionPool.pool.release(self.connection)
+            self.connection = None
+
+
+class SQLiteBackend:
+    # Class object which handles connections to a SQLite database with the same PROJECT/STUDY/EXPERIMENT/SAMPLE/RUN schema
+    # as ERAPRO, so the pipeline can be tested and load-tested locally. Lists of IDs are bound as a JSON array
+    list_expression = "SELECT value FROM json_each(:{})"  # Selects the elements of a bound list of IDs
+    current_time_query = "SELECT strftime('%Y-%m-%dT%H:%M:%S', 'now')"  # Obtains the current database time
+    max_collection_size = 1000000  # Maximum number of IDs bound in a single JSON array
+    schema = """
+        CREATE TABLE IF NOT EXISTS project (project_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS study (study_id TEXT PRIMARY KEY, project_id TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS experiment (experiment_id TEXT PRIMARY KEY, study_id TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS sample (sample_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS experiment_sample (experiment_id TEXT NOT NULL, sample_id TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS run (run_id TEXT PRIMARY KEY, experiment_id TEXT NOT NULL, first_created TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS study_project_idx ON study (project_id);
+        CREATE INDEX IF NOT EXISTS experiment_study_idx ON experiment (study_id);
+        CREATE INDEX IF NOT EXISTS experiment_sample_idx ON experiment_sample (experiment_id);
+        CREATE INDEX IF NOT EXISTS run_experiment_idx ON run (experiment_id);
+        """  # Subset of the ERAPRO schema used by the metadata query
+
+    def __init__(self, path):
+        self.path = path  # Path to the SQLite database
+        self.connection = None  # Database connection
+
+    @classmethod
+    def create_schema(cls, connection):
+        """
+        Create the tables used by the metadata query
+        :param connection: SQLite database connection
+        """
+        connection.executescript(cls.schema)
+
+    def setup_connection(self):
+        """
+        Set up the database connection
+        :return: Database connection object
+        """
+        self.connection = None
+        if not os.path.isfile(self.path):
+            sys.stderr.write("ERROR: SQLite database {} does not exist\n".format(self.path))
+            return None
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)  # May be set up ahead in another thread
+        return self.connection
+
+    def cursor(self, arraysize, prefetchrows):
+        """
+        Create a cursor on the database connection
+        :param arraysize: Number of rows fetched per call to fetchmany
+        :param prefetchrows: Unused, SQLite steps through rows as they are fetched
+        :return: Database cursor
+        """
+        cursor = self.connection.cursor()
+        cursor.arraysize = arraysize
+        return cursor
+
+    def bind_list(self, values):
+        """
+        Convert a list of IDs to the value bound for list_expression
+        :param values: List of IDs
+        :return: JSON array of the IDs
+        """
+        return json.dumps(list(values))
 
-    def fetch_metadata(self):
+    def bind_time(self, value):
         """
-        Obtain metadata from ERAPRO database
+        Convert a time to the value bound when comparing with the creation time of runs
+        :param value: Datetime object
+        :return: ISO 8601 string, as creation times are stored
+        """
+        return value.isoformat(timespec='seconds')
+
+    def current_time(self, cursor):
+        """
+        Obtain the current database time
+        :param cursor: Database cursor
+        :return: Datetime object
+        """
+        cursor.execute(self.current_time_query)
+        return datetime.fromisoformat(cursor.fetchone()[0])
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class MetadataFromDatabase:
+    # Class object which handles obtaining metadata from ERAPRO database, or a stand-in with the same schema, through a
+    # backend object. The query binds the project IDs as a list rather than placing them in the statement text, so it
+    # is parsed once, the parsed statement is reused from the statement cache, and any number of projects is fetched in
+    # a single round-trip. When the runs to be submitted are known, they are bound the same way so only those rows are
+    # returned rather than every run in the projects. With a cache, only runs created since the last snapshot are fetched
+    sql_query = """SELECT proj.project_id, samp.sample_id, ru.run_id FROM project proj
+                    JOIN study stu ON (proj.project_id = stu.project_id)
+                    JOIN experiment exp ON (stu.study_id = exp.study_id)
+                    JOIN experiment_sample expsamp ON (exp.experiment_id = expsamp.experiment_id)
+                    JOIN sample samp ON (expsamp.sample_id = samp.sample_id)
+                    JOIN run ru ON (exp.experiment_id = ru.experiment_id)
+                        WHERE proj.project_id IN ({project_ids})"""
+
+    run_filter = "\n                        AND ru.run_id IN ({run_ids})"
+    since_filter = "\n                        AND ru.first_created >= :since"
+
+    def __init__(self, projects, runs=None, arraysize=5000, prefetchrows=5000, backend=None, cache=None,
+                 cache_only=False):
+        self.projects = [projects] if isinstance(projects, str) else list(projects)  # Project IDs
+        self.runs = None if runs is None else sorted(runs)  # Run IDs to restrict the metadata to, None for all runs
+        self.arraysize = arraysize  # Number of rows fetched per round-trip and per streamed chunk
+        self.prefetchrows = prefetchrows  # Number of rows prefetched by the client on execution
+        self.backend = backend if backend is not None else OracleBackend()  # Database the metadata is obtained from
+        self.cache = cache  # MetadataCache object to obtain metadata through, None to always query the database
+        self.cache_only = cache_only  # Whether to use only the cache without connecting to the database
+        self.connection = None  # Database connection, set up on the first fetch
+        self.cursor = None  # Cursor, reused across fetches over the same connection
+
+    def get_cursor(self):
+        """
+        Obtain a cursor, connecting to the database on first use and reusing the same cursor afterwards
+        :return: Database cursor, or None if the connection could not be set up
+        """
+        if self.connection is None:
+            self.connection = self.backend.setup_connection()  # Set up the database connection
+            if self.connection is None:
+                return None
+        if self.cursor is None:
+            self.cursor = self.backend.cursor(self.arraysize, self.prefetchrows)
+        return self.cursor
+
+    def needs_database(self):
+        """
+        Check whether fetching metadata will query the database, rather than being served entirely from the cache
+        :return: True if the database will be queried
+        """
+        if self.cache_only:
+            return False
+        return self.cache is None or bool(self.cache.stale_projects(self.projects))
+
+    def connect(self):
+        """
+        Set up the database connection and cursor ahead of fetching, e.g. while the input files are still being read
+        :return: True if the connection was set up
+        """
+        return self.get_cursor() is not None
+
+    def fetch_metadata_chunks(self, projects=None, runs=None, since=None):
+        """
+        Stream metadata from the database in fixed-size chunks, so only one chunk of rows is held at a time
+        :param projects: Project IDs to obtain metadata for, defaults to the projects of this object
+        :param runs: Run IDs to restrict the metadata to, None for all runs
+        :param since: Only obtain runs created at or after this time, None for all runs
+        :return: Generator of dataframes of metadata, each of at most self.arraysize rows
+        """
+        cursor = self.get_cursor()
+        if cursor is None:
+            return
+        list_expression = self.backend.list_expression
+        binds = {'project_ids': self.backend.bind_list(projects or self.projects)}
+        query = self.sql_query.format(project_ids=list_expression.format('project_ids'))
+        if since is not None:
+            query += self.since_filter
+            binds['since'] = self.backend.bind_time(since)
+        if runs is None:
+            cursor.execute(query, binds)  # Query the database with the bound projects
+            yield from self.stream_chunks(cursor)
+            return
+        # Bind the runs in batches no larger than the backend allows, each reusing the same parsed statement
+        query += self.run_filter.format(run_ids=list_expression.format('run_ids'))
+        runs = list(runs)
+        max_collection_size = self.backend.max_collection_size
+        for start in range(0, len(runs), max_collection_size):
+            binds['run_ids'] = self.backend.bind_list(runs[start:start + max_collection_size])
+            cursor.execute(query, binds)
+            yield from self.stream_chunks(cursor)
+
+    def stream_chunks(self, cursor):
+        """
+        Stream the results of an executed query in fixed-size chunks
+        :param cursor: Database cursor on which the query has been executed
+        :return: Generator of dataframes of metadata, each of at most self.arraysize rows
+        """
+        while True:
+            rows = cursor.fetchmany(self.arraysize)
+            if not rows:
+                break
+            yield pd.DataFrame(rows, columns=METADATA_COLUMNS)
+
+    def iter_metadata(self, projects=None, runs=None):
+        """
+        Stream metadata from ERAPRO database chunk by chunk, or through the cache if this object has one
+        :param projects: Project IDs to obtain metadata for, defaults to the projects of this object
+        :param runs: Run IDs to restrict the metadata to, defaults to the runs of this object
+        :return: Generator of dataframes of metadata
+        """
+        projects = projects or self.projects
+        runs = self.runs if runs is None else runs
+        if self.cache is not None:
+            cached = self.fetch_cached_metadata(projects, runs)
+            if cached is not None:
+                yield cached
+            return
+        yield from self.fetch_metadata_chunks(projects, runs)
+
+    def fetch_metadata(self, projects=None, runs=None):
+        """
+        Obtain all metadata from ERAPRO database at once, or through the cache if this object has one. The spreadsheet
+        is built from iter_metadata instead, so that only one chunk of rows is held at a time
+        :param projects: Project IDs to obtain metadata for, defaults to the projects of this object
+        :param runs: Run IDs to restrict the metadata to, defaults to the runs of this object
+        :return: Dataframe of metadata, or None if the connection could not be set up
+        """
+        chunks = list(self.iter_metadata(projects, runs))
+        if self.connection is None and (self.cache is None or self.needs_database()):
+            return None
+        if not chunks:
+            return pd.DataFrame(columns=METADATA_COLUMNS)
+        return pd.concat(chunks, ignore_index=True)
+
+    def fetch_cached_metadata(self, projects, runs=None):
+        """
+        Obtain metadata through the cache, first refreshing any projects whose snapshot is missing or has expired.
+        Projects without a snapshot are fetched in full, the others only for runs created since their snapshot
+        :param projects: Project IDs to obtain metadata for
+        :param runs: Run IDs to restrict the metadata to, None for all runs
         :return: Dataframe of metadata
         """
-        self.get_oracle_usr_pwd()  # Obtain credentials from script operator
-        self.setup_connection()  # Set up the database connection using the credentials
+        stale = [] if self.cache_only else self.cache.stale_projects(projects)
+        if stale:
+            cursor = self.get_cursor()
+            if cursor is None:
+                return None
+            refreshed_at = self.backend.current_time(cursor)  # Database time of this snapshot, so the next refresh can start from it
+            snapshots = self.cache.snapshots(stale)
+            new = [project for project in stale if project not in snapshots]
+            if new:
+                self.cache.store(self.fetch_metadata_chunks(new), new, refreshed_at)
+            expired = [project for project in stale if project in snapshots]
+            if expired:
+                since = min(snapshots[project][0] for project in expired)
+                self.cache.store(self.fetch_metadata_chunks(expired, since=since), expired, refreshed_at)
+        elif self.cache_only:
+            missing = set(projects) - set(self.cache.snapshots(projects))
+            for project in sorted(missing):
+                sys.stderr.write("WARNING: Project {} is not in the cache\n".format(project))
+        return self.cache.read(projects, runs)
+
+    def close(self):
+        """
+        Close the cursor and the database connection
+        """
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
         if self.connection is not None:
-            cursor = self.connection.cursor()
-            search_query = cursor.execute(self.query)  # Query the database with the SQL query
-            df = pd.DataFrame(search_query.fetchall())  # Fetch all results and save to dataframe
-            df.columns = ['study_accession', 'sample_accession', 'run_accession']  # Add column headers to the dataframe
-            return df
+            self.backend.close()
+            self.connection = None
 
 
 def create_reference_column(df, final_columns):
@@ -96,69 +680,287 @@ def create_reference_column(df, final_columns):
     Create (add) a reference column for later joining with project metadata
     :param df: Pandas dataframe to be processed to include a new reference column
     :param final_columns: List of final columns of linked data should look like (e.g. ['FASTA', 'run_accession'])
-    :return:
-    """
-    linked_data = pd.DataFrame(columns=final_columns)
-    for index, row in df.iterrows():
-        item = row[0]  # This is the item that is to be linked to the project metadata
-        if 'FASTA' in final_columns:
-            # For fasta files, the separator was '.', whereas others were separated by '_'
-            run = item.split('.')[0]  # This is the run to link to, referred in the name of the item
-        else:
-            run = item.split('_')[0]  # This is the run to link to, referred in the name of the item
-        intermediate = pd.DataFrame([[item, run]], columns=final_columns)
-        linked_data = linked_data.append(intermediate, ignore_index=True)
+    :return: Dataframe of the items alongside the run they refer to, derived for the whole column in one pass
+    """
+    items = df.iloc[:, 0].astype(str)  # These are the items that are to be linked to the project metadata
+    names = items.str.rsplit(os.sep, n=1).str[-1]  # Items may be paths, the run is referred in the file name
+    # For fasta files, the separator was '.', whereas others were separated by '_'
+    separator = '.' if 'FASTA' in final_columns else '_'
+    runs = names.str.split(separator, n=1).str[0]  # These are the runs to link to, referred in the names of the items
+    linked_data = pd.DataFrame({final_columns[0]: items.to_numpy(), final_columns[1]: runs.to_numpy()},
+                               columns=final_columns)
     return linked_data
 
 
-if __name__ == '__main__':
-    args = get_args()
+def read_linked_list(path, final_columns):
+    """
+    Read a list file and create its reference column
+    :param path: Path to the list file, one item per line
+    :param final_columns: List of final columns of linked data should look like (e.g. ['FASTA', 'run_accession'])
+    :return: Dataframe of the items alongside the run they refer to
+    """
+    df = pd.read_csv(path, sep="\t", header=None)
+    return create_reference_column(df, final_columns)
+
+
+def read_fasta_paths(fasta_files, patterns=None, workers=None):
+    """
+    Obtain the paths of the fasta files to be submitted
+    :param fasta_files: Directory of fasta files, or list file of fasta file paths - one per line
+    :param patterns: Glob patterns matching fasta file names when discovering them in a directory
+    :param workers: Number of directories scanned at the same time when discovering them in a directory
+    :return: List of fasta file paths
+    """
+    if os.path.isdir(fasta_files):
+        return discover_files(fasta_files, patterns or ['*' + extension for extension in FASTA_EXTENSIONS], workers)
+    with open(fasta_files) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_linked_paths(paths, final_columns):
+    """
+    Create the reference column for a list of discovered file paths
+    :param paths: List of file paths
+    :param final_columns: List of final columns of linked data should look like (e.g. ['FASTA', 'run_accession'])
+    :return: Dataframe of the file paths alongside the run they refer to
+    """
+    return create_reference_column(pd.DataFrame(paths, dtype=object).reindex(columns=[0]), final_columns)
+
+
+def link_fasta_headers(fasta_paths, chromosome_list_dir='.', workers=None):
+    """
+    Derive the assembly names and chromosome list files from the fasta file headers, in a single pass over the headers
+    of each fasta file. Each fasta file is one assembly: its assembly name is the name of its first sequence and a
+    single chromosome list file listing every sequence is written for it, all linked to the run referred in the name
+    of the fasta file. Fasta files which cannot be read, or have no sequences, are left out with a warning
+    :param fasta_paths: Paths to the fasta files
+    :param chromosome_list_dir: Directory to write the chromosome list files to
+    :param workers: Number of fasta files scanned at the same time
+    :return: Dataframes of the linked fasta files, assembly names and chromosome list files
+    """
+    os.makedirs(chromosome_list_dir, exist_ok=True)
+
+    def scan(path):
+        try:
+            names = [sequence_name(header) for header in scan_headers(path)]
+        except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+            sys.stderr.write("WARNING: Could not read the headers of {}, it is left out: {}\n".format(path, e))
+            return path, run_accession(path), None, None
+        if not names:
+            sys.stderr.write("WARNING: {} has no sequences, it is left out\n".format(path))
+            return path, run_accession(path), None, None
+        if len(names) > 1:
+            sys.stderr.write("WARNING: {} has {} sequences, they are submitted as one assembly named {}\n".format(
+                path, len(names), names[0]))
+        chromosome_list = write_chromosome_list(names[0], chromosome_list_dir, object_names=names)
+        return path, run_accession(path), names[0], os.path.normpath(os.path.join(chromosome_list_dir, chromosome_list))
+
+    fasta_rows, name_rows, chromosome_list_rows = [], [], []
+    for path, run, name, chromosome_list in parallel_map(scan, fasta_paths, workers or os.cpu_count()):
+        if name is None:
+            continue
+        fasta_rows.append((path, run))
+        name_rows.append((name, run))
+        chromosome_list_rows.append((chromosome_list, run))
+    return (pd.DataFrame(fasta_rows, columns=['FASTA', 'run_accession']),
+            pd.DataFrame(name_rows, columns=['ASSEMBLYNAME', 'run_accession']),
+            pd.DataFrame(chromosome_list_rows, columns=['CHROMOSOME_LIST', 'run_accession']))
+
+
+def linked_runs(*linked_data):
+    """
+    Obtain the runs referred to by every one of the linked input files, i.e. the runs which will be submitted
+    :param linked_data: Dataframes of linked input files, each with a run_accession column
+    :return: Set of run accessions
+    """
+    runs = set(linked_data[0]['run_accession'])
+    for df in linked_data[1:]:
+        runs.intersection_update(df['run_accession'])
+    return runs
+
 
-    sql_query = "SELECT proj.project_id, samp.sample_id, ru.run_id FROM project proj \
-                    JOIN study stu ON (proj.project_id = stu.project_id) \
-                    JOIN experiment exp ON (stu.study_id = exp.study_id) \
-                    JOIN experiment_sample expsamp ON (exp.experiment_id = expsamp.experiment_id) \
-                    JOIN sample samp ON (expsamp.sample_id = samp.sample_id) \
-                    JOIN run ru ON (exp.experiment_id = ru.experiment_id) \
-                        WHERE proj.project_id='{}'".format(args.project)
-
-    # Get project metadata
-    metadata = MetadataFromDatabase(args.project, sql_query)
-    project_data = metadata.fetch_metadata()
-
-    # Read in all the data
-    assembly_names = pd.read_csv(args.names, sep="\t", header=None)
-    chromosome_lists = pd.read_csv(args.chromosome_list, sep="\t", header=None)
-    fasta_files = pd.read_csv(args.fasta_files, sep="\t", header=None)
-
-    # STEP 1 --> Create run accession columns for each dataframe to enable for merging with main dataframe
-    # Create column for the fasta file defining the corresponding run
-    linked_fasta_files = create_reference_column(fasta_files, ['FASTA', 'run_accession'])
-
-    # Create column for the assembly names defining the corresponding run
-    linked_assembly_names = create_reference_column(assembly_names, ['ASSEMBLYNAME', 'run_accession'])
-
-    # Create column for the chromosome list file names defining the corresponding run
-    linked_chromosome_lists = create_reference_column(chromosome_lists, ['CHROMOSOME_LIST', 'run_accession'])
-
-    # STEP 2 --> Create a dataframe of the preset paramaters
-    values = ['COVID-19 outbreak', 30, 'Minimap2', 'OXFORD_NANOPORE', 1, 'genomic DNA']
-    parameter_values = [values for _ in range(len(project_data))]
-    set_parameters = pd.DataFrame(parameter_values,
-                                  columns=['ASSEMBLY_TYPE', 'COVERAGE', 'PROGRAM', 'PLATFORM', 'MINGAPLENGTH',
-                                           'MOLECULETYPE'])
-
-    # STEP 3 --> Merge dataframes together
-    project_assembly = pd.merge(project_data, linked_assembly_names,
-                                on='run_accession')  # Include the assembly name information
-    project_assembly = pd.concat([project_assembly, set_parameters], axis=1,
-                                 sort=False)  # Include all the other set columns
-    project_assembly_fasta = pd.merge(project_assembly, linked_fasta_files,
-                                      on='run_accession')  # Include the names of fasta files
-    total_metadata = pd.merge(project_assembly_fasta, linked_chromosome_lists,
-                              on='run_accession')  # Include the names of chromosome list files
+class LinkedInputs:
+    # Class object which holds the linked input files combined into a single dataframe once, along with an index of the
+    # rows of each run, so that each chunk of metadata is joined by lookups costing as much as the chunk rather than by
+    # merging with every linked row again
+    def __init__(self, linked_assembly_names, linked_fasta_files, linked_chromosome_lists):
+        self.data = pd.merge(pd.merge(linked_assembly_names, linked_fasta_files, on='run_accession'),
+                             linked_chromosome_lists, on='run_accession').reset_index(drop=True)
+        codes, runs = pd.factorize(self.data['run_accession'])
+        self.runs = pd.Index(runs)  # Unique runs, whose hash table is built on the first lookup and then reused
+        self.order = np.argsort(codes, kind='stable')  # Rows grouped by run, keeping their order within each run
+        self.counts = np.bincount(codes, minlength=len(runs))  # Number of rows of each run
+        self.starts = np.cumsum(self.counts) - self.counts  # Position in self.order of the first row of each run
+
+    def rows_for(self, runs):
+        """
+        Locate the linked rows of runs
+        :param runs: Run accessions
+        :return: Positions in self.data of the linked rows of the runs, in order, and the number of rows of each run
+        """
+        if len(self.runs) == 0:
+            return np.empty(0, dtype=np.int64), np.zeros(len(runs), dtype=np.int64)
+        found = self.runs.get_indexer(runs)
+        counts = np.where(found >= 0, self.counts[found], 0)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)  # Position within each run
+        return self.order[np.repeat(self.starts[found], counts) + offsets], counts
+
+
+def create_project_metadata(project_data, linked_data, coverage=None):
+    """
+    Join metadata of a project with the linked input files to create its metadata spreadsheet
+    :param project_data: Dataframe of metadata for a single project, or a chunk of it
+    :param linked_data: LinkedInputs of the linked input files
+    :param coverage: Series of the coverage of each run indexed by run accession, replacing the preset COVERAGE for
+    those runs
+    :return: Dataframe of the metadata spreadsheet, with columns matching the manifest file headers
+    """
+    positions, counts = linked_data.rows_for(project_data['run_accession'])
+    linked_rows = linked_data.data.iloc[positions]
+
+    total_metadata = project_data.iloc[np.repeat(np.arange(len(project_data)), counts)].reset_index(drop=True)
+    total_metadata['ASSEMBLYNAME'] = linked_rows['ASSEMBLYNAME'].to_numpy()  # Include the assembly name information
+    for column, value in PRESET_PARAMETERS.items():
+        total_metadata[column] = value  # Include all the other set columns
+    total_metadata['FASTA'] = linked_rows['FASTA'].to_numpy()  # Include the names of fasta files
+    total_metadata['CHROMOSOME_LIST'] = linked_rows['CHROMOSOME_LIST'].to_numpy()  # Include the names of chromosome list files
+    if coverage is not None:
+        run_coverage = total_metadata['run_accession'].map(coverage)
+        total_metadata['COVERAGE'] = run_coverage.astype(object).where(
+            run_coverage.notna(), total_metadata['COVERAGE'])  # Preset, written as before, for runs without depth
 
     total_metadata = total_metadata.rename(columns={"study_accession": "STUDY", "sample_accession": "SAMPLE",
                                                     "run_accession": "RUN_REF"})  # Change column names to match the manifest file headers
-    metadata_filename = args.project + "_Consensus_Metadata.txt"
-    total_metadata.to_csv(metadata_filename, sep="\t", index=False)
+    return total_metadata
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    projects = get_projects(args)
+
+    cache = MetadataCache(args.cache, ttl=args.cache_ttl) if args.cache else None
+    if args.sqlite_db:
+        backend = SQLiteBackend(args.sqlite_db)
+    else:
+        backend = OracleBackend(dsn=args.dsn, credentials_file=args.credentials_file, external_auth=args.external_auth)
+    metadata = MetadataFromDatabase(projects, arraysize=args.arraysize, prefetchrows=args.prefetchrows,
+                                    backend=backend, cache=cache, cache_only=args.cache_only)
+    state = SubmissionState(args.state_db) if args.state_db else None
+
+    # STEP 1 --> Read in all the data and create run accession columns for each dataframe to enable for merging with
+    # main dataframe. The database login and connection are set up at the same time, so the total wait is the longer
+    # of the two rather than both
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        connecting = executor.submit(metadata.connect) if metadata.needs_database() else None
+        if args.depth_dir:
+            def shard_coverage():
+                depth_paths = discover_files(args.depth_dir, args.depth_pattern or DEPTH_PATTERNS, args.workers)
+                cache_name = '.coverage_cache.json'
+                if args.shard:  # Each array task reads and caches only the depth files of its own runs
+                    depth_paths = paths_in_shard(depth_paths, args.shard)
+                    cache_name = shard_filename(cache_name, *args.shard)
+                return compute_coverage(depth_paths, args.workers, os.path.join(args.depth_dir, cache_name))
+
+            coverage_future = executor.submit(shard_coverage)
+        if args.from_fasta_headers:
+            # Derive the assembly names and chromosome list files from the fasta files themselves
+            fasta_paths = read_fasta_paths(args.fasta_dir or args.fasta_files, args.fasta_pattern, args.workers)
+            if state is not None:
+                submitted = state.done_runs('submission', map(run_accession, fasta_paths))
+                fasta_paths = [path for path in fasta_paths if run_accession(path) not in submitted]
+            if args.shard:
+                fasta_paths = paths_in_shard(fasta_paths, args.shard)
+            linked_fasta_files, linked_assembly_names, linked_chromosome_lists = link_fasta_headers(
+                fasta_paths, args.chromosome_list_dir, args.workers)
+        else:
+            # Create columns for the fasta files, assembly names and chromosome list file names defining the corresponding
+            # run, discovering the files in directories if given rather than reading list files
+            if args.fasta_dir:
+                fasta_future = executor.submit(lambda: read_linked_paths(
+                    discover_files(args.fasta_dir, args.fasta_pattern, args.workers), ['FASTA', 'run_accession']))
+            else:
+                fasta_future = executor.submit(read_linked_list, args.fasta_files, ['FASTA', 'run_accession'])
+            names_future = executor.submit(read_linked_list, args.names, ['ASSEMBLYNAME', 'run_accession'])
+            if args.chromlist_dir:
+                chromosome_future = executor.submit(lambda: read_linked_paths(
+                    discover_files(args.chromlist_dir, args.chromlist_pattern, args.workers),
+                    ['CHROMOSOME_LIST', 'run_accession']))
+            else:
+                chromosome_future = executor.submit(read_linked_list, args.chromosome_list,
+                                                    ['CHROMOSOME_LIST', 'run_accession'])
+            linked_fasta_files = fasta_future.result()
+            linked_assembly_names = names_future.result()
+            linked_chromosome_lists = chromosome_future.result()
+        connected = connecting.result() if connecting is not None else True
+        coverage = coverage_future.result() if args.depth_dir else None
+    if args.shard:  # Leave out the runs of other shards before any of their files are checked
+        linked_fasta_files = linked_fasta_files[in_shard(linked_fasta_files['run_accession'], args.shard)]
+
+    # Check the consensus sequences, leaving out runs which fail so they are neither fetched nor submitted
+    if args.qc_report:
+        qc_report = shard_filename(args.qc_report, *args.shard) if args.shard else args.qc_report
+        qc = run_qc(linked_fasta_files['FASTA'], args.workers)
+        qc['PASSED'] = qc_passed(qc, args.min_length, args.max_n_fraction)
+        qc.to_csv(qc_report, sep="\t", index=False)
+        failed = failed_runs(qc, args.min_length, args.max_n_fraction)
+        if failed:
+            sys.stderr.write("WARNING: {} runs failed QC and are left out, see {}\n".format(len(failed), qc_report))
+            linked_fasta_files = linked_fasta_files[~linked_fasta_files['run_accession'].isin(failed)]
+
+    # Get metadata for all projects in a single query, restricted to the runs which have all of their input files
+    runs = linked_runs(linked_assembly_names, linked_fasta_files, linked_chromosome_lists)
+    if state is not None:
+        runs.difference_update(state.done_runs('submission', runs))  # Leave out runs submitted by a previous run
+    if not connected:
+        sys.stderr.write("ERROR: Could not obtain project metadata from the database\n")
+        exit(1)
+
+    # STEP 2 --> Join each chunk of the result set with the linked data as it arrives and append it to the spreadsheet of
+    # its project, so only one chunk of metadata rows is held at a time
+    linked_data = LinkedInputs(linked_assembly_names, linked_fasta_files, linked_chromosome_lists)
+    if coverage is not None:
+        coverage = coverage.set_index('run_accession')['COVERAGE']
+    sharded = args.shards or args.rows_per_shard  # Balanced shards need all the rows of a project before writing
+    metadata_filenames = {project: project + "_Consensus_Metadata.txt" for project in projects}
+    if args.shard:  # Merged by sharding.py once all shards are done
+        metadata_filenames = {project: shard_filename(filename, *args.shard) for project, filename in metadata_filenames.items()}
+    written, project_chunks = {}, {}
+    for chunk in metadata.iter_metadata(runs=runs):
+        for project, project_runs in chunk.groupby('study_accession', sort=False):
+            total_metadata = create_project_metadata(project_runs, linked_data, coverage)
+            if sharded:
+                project_chunks.setdefault(project, []).append(total_metadata)
+            else:
+                total_metadata.to_csv(metadata_filenames[project] + '.tmp', sep="\t", index=False,
+                                      mode='a' if project in written else 'w', header=project not in written)
+            written[project] = written.get(project, 0) + len(total_metadata)
+            if args.manifest_dir:
+                write_manifests(total_metadata, args.manifest_dir, args.workers)
+            if state is not None:  # Record only the files this script wrote, the FASTA files are checked by validation
+                if args.from_fasta_headers:
+                    state.mark_done('chromosome_list', total_metadata['RUN_REF'])
+                if args.manifest_dir:
+                    state.mark_done('manifest', total_metadata['RUN_REF'])
+    metadata.close()
+    OracleSessionPool.close()
+    if cache is not None:
+        cache.close()
+
+    for project in projects:
+        metadata_filename = metadata_filenames[project]
+        if project not in written:
+            if not args.shard:
+                sys.stderr.write("WARNING: No runs found in the database for project {}\n".format(project))
+                continue
+            # Other shards may have runs of the project, so a header-only file shows this shard was done
+            create_project_metadata(pd.DataFrame(columns=METADATA_COLUMNS), linked_data).to_csv(
+                metadata_filename, sep="\t", index=False)
+        elif sharded:
+            total_metadata = pd.concat(project_chunks.pop(project), ignore_index=True)
+            write_shards(total_metadata, metadata_filename,
+                         shard_count(len(total_metadata), args.shards, args.rows_per_shard), args.shard_by)
+        else:
+            os.replace(metadata_filename + '.tmp', metadata_filename)  # Complete, so never a partial spreadsheet
+    if state is not None:
+        state.close()
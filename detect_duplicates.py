@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+# Script to detect consensus sequences submitted under more than one run. Each sequence is normalised (upper case,
+# without line breaks) and hashed, files are hashed in a process pool, and digests are compared within the batch and
+# against a persistent SQLite store of the digests of past submissions.
+
+import argparse, hashlib, os, sqlite3, sys, zlib
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from fasta_utils import read_records, run_accession, sequence_name
+
+DIGEST_COLUMNS = ['run_accession', 'FASTA', 'sequence', 'length', 'digest']  # Columns of the digests of a batch
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  detect_duplicates.py                                                 |
+        |  Tool which detects identical consensus sequences within a batch      |
+        |  and against previously submitted sequences.                          |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-f', '--fasta_files', type=str, required=True,
+                        help='Fasta files of the batch. Format: List of names of fasta files - one per line')
+    parser.add_argument('-s', '--store', type=str, default='submitted_digests.db',
+                        help='SQLite store of the digests of previously submitted sequences (default: submitted_digests.db)')
+    parser.add_argument('-o', '--output', type=str, default='duplicates_report.txt',
+                        help='Report of the duplicated sequences to write (default: duplicates_report.txt)')
+    parser.add_argument('--record', action='store_true',
+                        help='Add the digests of this batch to the store once it has been submitted. Only done if no duplicates are found and every file could be read')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of fasta files hashed at the same time (default: number of CPUs)')
+    args = parser.parse_args()
+    return args
+
+
+def sequence_digest(sequence):
+    """
+    Compute the digest of a sequence, ignoring case and line wrapping
+    :param sequence: Sequence (bytes, without line breaks)
+    :return: SHA-256 hex digest
+    """
+    return hashlib.sha256(sequence.upper()).hexdigest()
+
+
+def fasta_digests(path):
+    """
+    Compute the digest of every sequence in a FASTA file, streaming one record at a time
+    :param path: Path to the FASTA file, gzipped if ending in .gz
+    :return: List of (run accession, FASTA, sequence name, length, digest) tuples, and the error if the file could
+    not be read (None otherwise)
+    """
+    run = run_accession(path)
+    try:
+        return [(run, path, sequence_name(header), len(sequence), sequence_digest(sequence))
+                for header, sequence in read_records(path)], None
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+        return [], str(e)
+
+
+def batch_digests(fasta_paths, workers=None):
+    """
+    Compute the digests of the sequences of a batch of FASTA files in a process pool
+    :param fasta_paths: Paths to the FASTA files
+    :param workers: Number of FASTA files hashed at the same time (default: number of CPUs)
+    :return: Dataframe of the digests, one row per sequence, and list of the paths of the files which could not be read
+    """
+    fasta_paths = list(fasta_paths)
+    workers = workers or os.cpu_count()
+    rows, unreadable = [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(fasta_digests, fasta_paths, chunksize=max(1, len(fasta_paths) // (32 * workers)))
+        for path, (file_rows, error) in zip(fasta_paths, results):
+            if error is not None:
+                sys.stderr.write("WARNING: Could not read {}, its sequences are not checked: {}\n".format(path, error))
+                unreadable.append(path)
+            rows.extend(file_rows)
+    return pd.DataFrame(rows, columns=DIGEST_COLUMNS), unreadable
+
+
+class DigestStore:
+    # Class object which handles the SQLite store of the digests of previously submitted sequences
+    def __init__(self, path):
+        self.path = path  # Path to the SQLite store
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS digest (
+                digest TEXT NOT NULL,
+                run_accession TEXT NOT NULL,
+                sequence TEXT NOT NULL,
+                recorded_at TEXT NOT NULL,
+                PRIMARY KEY (digest, run_accession, sequence));
+            """)
+
+    def lookup(self, digests):
+        """
+        Find previously submitted sequences with any of the digests, through a temporary table joined on the indexed
+        digest column rather than one query per digest
+        :param digests: Iterable of digests
+        :return: Dataframe of digest and run_accession of the matching previous submissions
+        """
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS batch_digest (digest TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM batch_digest")
+            self.connection.executemany("INSERT OR IGNORE INTO batch_digest VALUES (?)", ((d,) for d in digests))
+        return pd.read_sql_query("SELECT d.digest, d.run_accession FROM digest d JOIN batch_digest b USING (digest)",
+                                 self.connection)
+
+    def record(self, digests):
+        """
+        Add the digests of a batch to the store
+        :param digests: Dataframe of the digests, as created by batch_digests
+        """
+        recorded_at = datetime.now().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO digest VALUES (?, ?, ?, ?)",
+                                        ((row.digest, row.run_accession, row.sequence, recorded_at)
+                                         for row in digests.itertuples(index=False)))
+
+    def close(self):
+        """
+        Close the store
+        """
+        self.connection.close()
+
+
+def find_duplicates(digests, previous=None):
+    """
+    Find the sequences of a batch which are identical to another sequence of a different run, in the batch or submitted
+    previously
+    :param digests: Dataframe of the digests of the batch
+    :param previous: Dataframe of digest and run_accession of matching previous submissions, None to only check the batch
+    :return: Dataframe of the duplicated sequences with the other runs they are identical to
+    """
+    runs_by_digest = digests.groupby('digest')['run_accession'].agg(set)
+    previous_by_digest = previous.groupby('digest')['run_accession'].agg(set) if previous is not None and len(previous) else pd.Series(dtype=object)
+    report = digests.copy()
+    report['duplicate_in_batch'] = [','.join(sorted(runs_by_digest[d] - {run})) for d, run in zip(report['digest'], report['run_accession'])]
+    report['previously_submitted'] = [','.join(sorted(previous_by_digest.get(d, set()) - {run})) for d, run in zip(report['digest'], report['run_accession'])]
+    return report[(report['duplicate_in_batch'] != '') | (report['previously_submitted'] != '')].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    with open(args.fasta_files) as f:
+        fasta_paths = [line.strip() for line in f if line.strip()]
+    digests, unreadable = batch_digests(fasta_paths, args.workers)
+    store = DigestStore(args.store)
+    duplicates = find_duplicates(digests, store.lookup(digests['digest']))
+    duplicates.to_csv(args.output, sep="\t", index=False)
+    if args.record:
+        if len(duplicates) or unreadable:
+            sys.stderr.write("WARNING: Duplicates were found or files could not be read, the digests of this batch are not recorded\n")
+        else:
+            store.record(digests)
+    store.close()
+    print("number of sequences hashed: {}, duplicated: {}, unreadable files: {}".format(
+        len(digests), len(duplicates), len(unreadable)))
+    if len(duplicates) or unreadable:
+        exit(1)
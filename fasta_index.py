@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+# Script to index FASTA files for random access, so single consensus sequences can be read from large multi-FASTA files
+# without scanning them. The index is a samtools-compatible .fai; bgzip-compressed files also get a samtools-compatible
+# .gzi of BGZF block offsets. Plain gzip files cannot be indexed, recompress them with bgzip.
+
+import argparse, bisect, os, struct, sys, zlib
+from fasta_utils import open_fasta, sequence_name
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  fasta_index.py                                                       |
+        |  Tool which creates samtools-compatible .fai (and .gzi for bgzip)     |
+        |  indexes of FASTA files, and fetches sequences using them.            |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('fasta', type=str, nargs='+', help='FASTA files to index, plain or bgzip-compressed')
+    parser.add_argument('--fetch', type=str, action='append', default=[],
+                        help='Name of a sequence to print from the (single) FASTA file, can be repeated')
+    args = parser.parse_args()
+    if args.fetch and len(args.fasta) > 1:
+        parser.error('--fetch can only be used with a single FASTA file')
+    return args
+
+
+def is_bgzf(path):
+    """
+    Check whether a file is BGZF (bgzip) compressed, i.e. gzip with a 'BC' extra subfield
+    :param path: Path to the file
+    :return: True if the file is BGZF compressed
+    """
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def read_bgzf_block_header(f):
+    """
+    Read the header of the BGZF block at the current position
+    :param f: File object opened in binary mode
+    :return: Total size of the block in bytes and length of its extra field, or None at the end of the file
+    """
+    header = f.read(12)
+    if len(header) < 12:
+        return None
+    if header[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError("Not a BGZF block at offset {}".format(f.tell() - len(header)))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = f.read(xlen)
+    position = 0
+    while position + 4 <= xlen:
+        subfield_id, subfield_length = extra[position:position + 2], struct.unpack('<H', extra[position + 2:position + 4])[0]
+        if subfield_id == b'BC':
+            return struct.unpack('<H', extra[position + 4:position + 6])[0] + 1, xlen
+        position += 4 + subfield_length
+    raise ValueError("BGZF block without a block size")
+
+
+def build_gzi(path):
+    """
+    Build the block index of a BGZF file from the block headers, without decompressing
+    :param path: Path to the BGZF file
+    :return: List of (compressed offset, uncompressed offset) tuples for every block after the first
+    """
+    entries = []
+    compressed, uncompressed = 0, 0
+    with open(path, 'rb') as f:
+        while True:
+            f.seek(compressed)
+            block = read_bgzf_block_header(f)
+            if block is None:
+                break
+            block_size = block[0]
+            f.seek(compressed + block_size - 4)
+            uncompressed_size = struct.unpack('<I', f.read(4))[0]
+            if compressed > 0 and uncompressed_size > 0:
+                entries.append((compressed, uncompressed))
+            compressed += block_size
+            uncompressed += uncompressed_size
+    return entries
+
+
+def write_gzi(entries, path):
+    """
+    Write a block index in the samtools .gzi format: the number of entries followed by offset pairs, as little-endian
+    64-bit integers
+    :param entries: List of (compressed offset, uncompressed offset) tuples
+    :param path: Path to the .gzi file
+    """
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(entries)))
+        for entry in entries:
+            f.write(struct.pack('<QQ', *entry))
+
+
+def read_gzi(path):
+    """
+    Read a block index in the samtools .gzi format
+    :param path: Path to the .gzi file
+    :return: List of (compressed offset, uncompressed offset) tuples
+    """
+    with open(path, 'rb') as f:
+        count = struct.unpack('<Q', f.read(8))[0]
+        return [struct.unpack('<QQ', f.read(16)) for _ in range(count)]
+
+
+def build_fai(path):
+    """
+    Build the samtools .fai index of a FASTA file in a single streaming pass. Every line of a sequence except the last
+    must have the same length, as random access relies on it. Empty sequences are left out, as samtools does
+    :param path: Path to the FASTA file, plain or compressed
+    :return: List of (name, length, offset, line bases, line width) tuples, offsets in uncompressed bytes
+    """
+    entries = []
+    record = None  # Name, length, offset, line bases, line width and whether a short (last) line has been seen
+    offset = 0
+    with open_fasta(path) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if record is not None:
+                    entries.append(tuple(record[:5]))
+                record = [sequence_name(line[1:].decode()), 0, offset + len(line), None, None, False]
+            elif record is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if record[3] is None:
+                    record[3], record[4] = bases, len(line)
+                elif record[5]:
+                    if bases:
+                        raise ValueError("Different line length in sequence '{}' of {}".format(record[0], path))
+                elif bases != record[3] or len(line) != record[4]:
+                    if bases > record[3]:
+                        raise ValueError("Different line length in sequence '{}' of {}".format(record[0], path))
+                    record[5] = True
+                record[1] += bases
+            offset += len(line)
+    if record is not None:
+        entries.append(tuple(record[:5]))
+    return [entry for entry in entries if entry[1] > 0]
+
+
+def write_fai(entries, path):
+    """
+    Write a samtools .fai index
+    :param entries: List of (name, length, offset, line bases, line width) tuples
+    :param path: Path to the .fai file
+    """
+    with open(path, 'w') as f:
+        for entry in entries:
+            f.write('\t'.join(str(value) for value in entry) + '\n')
+
+
+def read_fai(path):
+    """
+    Read a samtools .fai index
+    :param path: Path to the .fai file
+    :return: List of (name, length, offset, line bases, line width) tuples
+    """
+    with open(path) as f:
+        return [(fields[0], *(int(value) for value in fields[1:5])) for fields in (line.rstrip('\n').split('\t') for line in f)]
+
+
+def index_fasta(path):
+    """
+    Create the .fai index of a FASTA file, and the .gzi index if it is BGZF compressed
+    :param path: Path to the FASTA file
+    :return: List of .fai entries
+    """
+    if path.endswith('.gz') and not is_bgzf(path):
+        raise ValueError("{} is gzip but not bgzip compressed and cannot be indexed, recompress it with bgzip".format(path))
+    entries = build_fai(path)
+    write_fai(entries, path + '.fai')
+    if path.endswith('.gz'):
+        write_gzi(build_gzi(path), path + '.gzi')
+    return entries
+
+
+class IndexedFasta:
+    # Class object which handles random access to the sequences of an indexed FASTA file. Missing or outdated indexes
+    # are (re)built on opening
+    def __init__(self, path):
+        self.path = path  # Path to the FASTA file
+        self.bgzf = path.endswith('.gz')  # Whether the file is BGZF compressed
+        if self.index_outdated(path + '.fai') or (self.bgzf and self.index_outdated(path + '.gzi')):
+            index_fasta(path)
+        self.index = {entry[0]: entry for entry in read_fai(path + '.fai')}  # Sequence name to .fai entry
+        if self.bgzf:
+            self.blocks = [(0, 0)] + read_gzi(path + '.gzi')  # Block offsets, including the first block
+            self.block_starts = [uncompressed for _, uncompressed in self.blocks]
+        self.file = open(path, 'rb')
+
+    def index_outdated(self, index_path):
+        """
+        Check whether an index is missing or older than the FASTA file
+        :param index_path: Path to the index file
+        :return: True if the index needs to be built
+        """
+        return not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(self.path)
+
+    def read(self, offset, size):
+        """
+        Read bytes from an uncompressed offset of the file
+        :param offset: Offset in the uncompressed file
+        :param size: Number of bytes to read
+        :return: Bytes read
+        """
+        if not self.bgzf:
+            self.file.seek(offset)
+            return self.file.read(size)
+        block = bisect.bisect_right(self.block_starts, offset) - 1
+        compressed, uncompressed = self.blocks[block]
+        self.file.seek(compressed)
+        data = bytearray()
+        skip = offset - uncompressed
+        while len(data) < skip + size:
+            start = self.file.tell()
+            header = read_bgzf_block_header(self.file)
+            if header is None:
+                break
+            block_size, xlen = header
+            self.file.seek(start + 12 + xlen)
+            data += zlib.decompress(self.file.read(block_size - xlen - 20), -15)
+            self.file.seek(start + block_size)
+        return bytes(data[skip:skip + size])
+
+    def fetch(self, name):
+        """
+        Fetch a sequence by name
+        :param name: Sequence name
+        :return: Sequence (bytes, without line breaks)
+        """
+        _, length, offset, line_bases, line_width = self.index[name]
+        size = (length // line_bases) * line_width + line_bases  # Enough bytes to cover the sequence and line breaks
+        data = self.read(offset, size)
+        return data.replace(b'\r', b'').replace(b'\n', b'')[:length]
+
+    def names(self):
+        """
+        Obtain the names of the sequences in the file
+        :return: List of sequence names, in file order
+        """
+        return list(self.index)
+
+    def close(self):
+        """
+        Close the FASTA file
+        """
+        self.file.close()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    for path in args.fasta:
+        try:
+            fasta = IndexedFasta(path)
+        except ValueError as error:
+            sys.stderr.write("ERROR: {}\n".format(error))
+            exit(1)
+        for name in args.fetch:
+            if name not in fasta.index:
+                sys.stderr.write("ERROR: Sequence {} not found in {}\n".format(name, path))
+                exit(1)
+            sys.stdout.write('>' + name + '\n' + fasta.fetch(name).decode() + '\n')
+        fasta.close()
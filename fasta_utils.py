@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+# Utilities shared by the scripts which read consensus FASTA files and discover input files.
+
+import fnmatch, gzip, mmap, os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+FASTA_EXTENSIONS = ('.fasta', '.fa', '.fna', '.fas', '.fasta.gz', '.fa.gz', '.fna.gz', '.fas.gz')  # Recognised FASTA file names
+
+
+def is_fasta(path):
+    """
+    Check whether a file name has a recognised FASTA extension
+    :param path: Path to the file
+    :return: True if the file is a FASTA file
+    """
+    return path.lower().endswith(FASTA_EXTENSIONS)
+
+
+def run_accession(path):
+    """
+    Obtain the run a consensus FASTA file belongs to, referred in the name of the file (e.g. ERR4080473.fasta.gz)
+    :param path: Path to the FASTA file
+    :return: Run accession
+    """
+    return os.path.basename(path).split('.')[0]
+
+
+def sequence_name(header):
+    """
+    Obtain the name of a sequence from its header line, i.e. the first word after '>'
+    :param header: Header line, with or without the leading '>'
+    :return: Sequence name
+    """
+    fields = header.lstrip('>').split()
+    return fields[0] if fields else ''
+
+
+def open_fasta(path):
+    """
+    Open a FASTA file for reading in binary mode
+    :param path: Path to the FASTA file, gzipped if ending in .gz
+    :return: File object
+    """
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def read_records(path):
+    """
+    Stream the records of a FASTA file, holding only one record in memory at a time
+    :param path: Path to the FASTA file, gzipped if ending in .gz
+    :return: Generator of header line (without the leading '>') and sequence (bytes, without line breaks) tuples
+    """
+    header, sequence = None, []
+    with open_fasta(path) as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'>'):
+                if header is not None:
+                    yield header, b''.join(sequence)
+                header, sequence = line[1:].decode(), []
+            elif header is not None:
+                sequence.append(line.strip())
+    if header is not None:
+        yield header, b''.join(sequence)
+
+
+def format_record(header, sequence, width=60):
+    """
+    Format a FASTA record, wrapping the sequence
+    :param header: Header line, without the leading '>'
+    :param sequence: Sequence (bytes)
+    :param width: Number of bases per line
+    :return: FASTA record (bytes)
+    """
+    lines = [b'>' + header.encode()]
+    lines.extend(sequence[i:i + width] for i in range(0, len(sequence), width))
+    return b'\n'.join(lines) + b'\n'
+
+
+def scan_headers(path):
+    """
+    Stream the header lines of a FASTA file without reading sequence lines into Python. Uncompressed files are memory
+    mapped and searched for line starts with '>', gzipped files are decompressed in a single pass
+    :param path: Path to the FASTA file, gzipped if ending in .gz
+    :return: Generator of header lines, without the leading '>' and line ending
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    yield line[1:].rstrip(b'\r\n').decode()
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:1] == b'>':
+                start = 0
+            else:
+                start = mm.find(b'\n>') + 1  # Position of the first header, 0 if there is none
+                if start == 0:
+                    return
+            while True:
+                end = mm.find(b'\n', start)
+                if end == -1:
+                    end = len(mm)
+                yield mm[start + 1:end].rstrip(b'\r').decode()
+                start = mm.find(b'\n>', end) + 1  # Position of the next header, 0 if there is none
+                if start == 0:
+                    break
+
+
+def scan_directory(directory, patterns):
+    """
+    List the files in a single directory whose names match any of the patterns, along with its subdirectories
+    :param directory: Directory to scan
+    :param patterns: Glob patterns to match file names against
+    :return: List of matching file paths and list of subdirectory paths
+    """
+    files, subdirectories = [], []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif any(fnmatch.fnmatch(entry.name, pattern) for pattern in patterns):
+                files.append(entry.path)
+    return files, subdirectories
+
+
+def discover_files(directory, patterns, workers=None):
+    """
+    Discover the files under a directory whose names match any of the patterns. Directories are scanned in parallel,
+    with each subdirectory submitted to the pool as soon as its parent has been scanned
+    :param directory: Directory to search
+    :param patterns: Glob patterns to match file names against
+    :param workers: Number of directories scanned at the same time (default: number of CPUs)
+    :return: Sorted list of matching file paths
+    """
+    matches = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        pending = {executor.submit(scan_directory, directory, patterns)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                matches.extend(files)
+                pending.update(executor.submit(scan_directory, subdirectory, patterns) for subdirectory in subdirectories)
+    return sorted(matches)
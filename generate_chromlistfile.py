@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Script to create gzipped chromosome list files for the consensus sequences, one per sequence header.
+# Python replacement for generate_chromlistfile.sh: the headers file is streamed and each chromosome list file is
+# compressed in-process, so any number of headers can be handled without shell globbing.
+
+import argparse, gzip, os
+from compress_outputs import parallel_map
+from sharding import in_shard, parse_shard, shard_filename
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  generate_chromlistfile.py                                            |
+        |  Tool which creates a gzipped chromosome list file for each           |
+        |  consensus sequence header, along with a list of the files created.   |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('headers', type=str,
+                        help='Consensus/assembled sequence headers to create chromosome list files for. Format: List of consensus/assembled sequence headers - one per line')
+    parser.add_argument('-o', '--output_dir', type=str, default='.',
+                        help='Directory to write the chromosome list files to (default: current directory)')
+    parser.add_argument('-l', '--list_file', type=str, default='chromosome_list_files.txt',
+                        help='Name of the file listing the chromosome list files created, written to the output directory (default: chromosome_list_files.txt)')
+    parser.add_argument('--compresslevel', type=int, default=6, help='Gzip compression level (default: 6)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of chromosome list files compressed and written at the same time (default: number of CPUs)')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='Only create the chromosome list files of the runs of shard i of N, assigned by a stable hash of the run accession (the part of the header before the first underscore), e.g. $SLURM_ARRAY_TASK_ID/N for array tasks 1-N. The list file written is named per shard. Format: i/N')
+    args = parser.parse_args()
+    return args
+
+
+def read_headers(headers_file):
+    """
+    Stream the sequence headers from a headers file
+    :param headers_file: Path to the headers file, one header per line
+    :return: Generator of sequence headers
+    """
+    with open(headers_file) as f:
+        for line in f:
+            yield from line.split()  # Headers are whitespace separated, as read by generate_chromlistfile.sh
+
+
+def shard_headers(headers, shard, batch_size=100000):
+    """
+    Keep the sequence headers of the runs in a shard, the run being the part of the header before the first underscore
+    :param headers: Iterable of sequence headers
+    :param shard: Tuple of the shard number (from 1) and number of shards
+    :param batch_size: Number of headers hashed at a time
+    :return: Generator of the sequence headers in the shard
+    """
+    batch = []
+    for header in headers:
+        batch.append(header)
+        if len(batch) >= batch_size:
+            yield from (header for header, keep in zip(batch, in_shard((h.split('_')[0] for h in batch), shard)) if keep)
+            batch = []
+    yield from (header for header, keep in zip(batch, in_shard((h.split('_')[0] for h in batch), shard)) if keep)
+
+
+def chromosome_list_filename(header):
+    """
+    Obtain the name of the chromosome list file for a sequence header
+    :param header: Sequence header
+    :return: Chromosome list file name
+    """
+    return header + '_chromosomelist.txt.gz'
+
+
+def write_chromosome_list(header, output_dir, compresslevel=6, object_names=None):
+    """
+    Write the gzipped chromosome list file for a sequence header
+    :param header: Sequence header, used as the object name of the chromosome list and to name the file
+    :param output_dir: Directory to write the chromosome list file to
+    :param compresslevel: Gzip compression level
+    :param object_names: Names of all the sequences of the assembly, if it has more than one. They are listed as the
+    numbered segments of a segmented chromosome, as each object of a chromosome list needs a unique chromosome name
+    :return: Name of the chromosome list file written
+    """
+    filename = chromosome_list_filename(header)
+    if object_names and len(object_names) > 1:
+        content = ''.join('{}\t{}\tSegmented\n'.format(name, number) for number, name in enumerate(object_names, 1))
+    else:
+        content = '{}\t1\tMonopartite\n'.format(header)
+    with open(os.path.join(output_dir, filename), 'wb') as f:
+        f.write(gzip.compress(content.encode(), compresslevel=compresslevel, mtime=0))
+    return filename
+
+
+if __name__ == '__main__':
+    args = get_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    headers = read_headers(args.headers)
+    list_filename = args.list_file
+    if args.shard:
+        headers = shard_headers(headers, args.shard)
+        list_filename = shard_filename(list_filename, *args.shard)
+
+    count = 0
+    with open(os.path.join(args.output_dir, list_filename), 'w') as list_file:
+        written = parallel_map(lambda header: write_chromosome_list(header, args.output_dir, args.compresslevel),
+                               headers, args.workers)
+        for filename in written:
+            list_file.write(filename + '\n')
+            count += 1
+    print("number of chromosome list files generated: {}".format(count))
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# Script to compute quality control statistics of consensus sequences before submission: length, fraction and longest
+# run of N, GC content and characters which are not IUPAC nucleotide codes. Each FASTA file is memory mapped and its
+# sequences are processed as NumPy byte arrays, with files spread across a process pool.
+
+import argparse, gzip, mmap, os, zlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from fasta_utils import run_accession, sequence_name
+
+QC_COLUMNS = ['run_accession', 'FASTA', 'sequence', 'length', 'n_fraction', 'longest_n_run', 'gc_fraction',
+              'invalid_characters', 'error']  # Columns of the QC report, one row per sequence
+IUPAC_CODES = b'ACGTURYSWKMBDHVN-'  # Characters allowed in a nucleotide sequence, in upper case
+
+_IUPAC_LOOKUP = np.zeros(256, dtype=bool)
+_IUPAC_LOOKUP[np.frombuffer(IUPAC_CODES + IUPAC_CODES.lower(), dtype=np.uint8)] = True
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  sequence_qc.py                                                       |
+        |  Tool which computes quality control statistics of consensus          |
+        |  sequences and checks them against submission thresholds.             |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-f', '--fasta_files', type=str, required=True,
+                        help='Fasta files to check. Format: List of names of fasta files - one per line')
+    parser.add_argument('-o', '--output', type=str, default='qc_report.txt',
+                        help='QC report to write, one row per sequence (default: qc_report.txt)')
+    parser.add_argument('--min_length', type=int, default=0, help='Minimum sequence length to pass (default: 0)')
+    parser.add_argument('--max_n_fraction', type=float, default=1.0,
+                        help='Maximum fraction of N in a sequence to pass (default: 1.0)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of fasta files checked at the same time (default: number of CPUs)')
+    args = parser.parse_args()
+    return args
+
+
+def sequence_stats(sequence):
+    """
+    Compute the QC statistics of a sequence
+    :param sequence: NumPy uint8 array of the sequence, without line breaks
+    :return: Dictionary of length, N fraction, longest N run, GC fraction (of A, C, G and T bases) and number of
+             invalid characters
+    """
+    upper = sequence & 0xDF  # Clear the lower case bit, invalid characters are counted before this
+    length = len(sequence)
+    is_n = upper == ord('N')
+    n_count = int(np.count_nonzero(is_n))
+    gc_count = int(np.count_nonzero((upper == ord('G')) | (upper == ord('C'))))
+    at_count = int(np.count_nonzero((upper == ord('A')) | (upper == ord('T'))))
+    longest_n_run = 0
+    if n_count:
+        edges = np.diff(np.concatenate(([0], is_n.view(np.int8), [0])))
+        longest_n_run = int((np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)).max())
+    return {'length': length,
+            'n_fraction': n_count / length if length else 0.0,
+            'longest_n_run': longest_n_run,
+            'gc_fraction': gc_count / (gc_count + at_count) if gc_count + at_count else 0.0,
+            'invalid_characters': int(length - np.count_nonzero(_IUPAC_LOOKUP[sequence]))}
+
+
+def fasta_arrays(data):
+    """
+    Split the contents of a FASTA file into its sequences
+    :param data: NumPy uint8 array of the file contents
+    :return: Generator of header line and NumPy uint8 array of the sequence (without line breaks) tuples
+    """
+    newlines = np.flatnonzero(data == ord('\n'))
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_starts = line_starts[line_starts < len(data)]
+    header_starts = line_starts[data[line_starts] == ord('>')]
+    header_ends = np.append(newlines, len(data))[np.searchsorted(newlines, header_starts)]  # Line break after each header
+    record_ends = np.append(header_starts[1:], len(data))
+    for start, header_end, record_end in zip(header_starts, header_ends, record_ends):
+        block = data[header_end + 1:record_end]
+        sequence = block[(block != ord('\n')) & (block != ord('\r'))]
+        yield bytes(data[start + 1:header_end]).rstrip(b'\r').decode(), sequence
+
+
+def fasta_qc(path):
+    """
+    Compute the QC statistics of every sequence in a FASTA file. Uncompressed files are memory mapped, gzipped files
+    are decompressed into memory
+    :param path: Path to the FASTA file
+    :return: List of QC report rows, a single row with the error if the file could not be read
+    """
+    run = run_accession(path)
+    try:
+        if path.endswith('.gz'):
+            with gzip.open(path, 'rb') as f:
+                records = [(header, sequence_stats(sequence))
+                           for header, sequence in fasta_arrays(np.frombuffer(f.read(), dtype=np.uint8))]
+        elif os.path.getsize(path) == 0:
+            records = []
+        else:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = np.frombuffer(mm, dtype=np.uint8)
+                records = [(header, sequence_stats(sequence)) for header, sequence in fasta_arrays(data)]
+                del data  # Release the buffer before the memory map is closed
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError) as error:
+        return [dict(run_accession=run, FASTA=path, sequence=None, error=str(error))]
+    if not records:
+        return [dict(run_accession=run, FASTA=path, sequence=None, error='No sequences found')]
+    return [dict(run_accession=run, FASTA=path, sequence=sequence_name(header), error=None, **stats)
+            for header, stats in records]
+
+
+def run_qc(fasta_paths, workers=None):
+    """
+    Compute the QC statistics of FASTA files in a process pool
+    :param fasta_paths: Paths to the FASTA files
+    :param workers: Number of FASTA files checked at the same time (default: number of CPUs)
+    :return: Dataframe of the QC report, one row per sequence, joinable by run_accession
+    """
+    fasta_paths = list(fasta_paths)
+    workers = workers or os.cpu_count()
+    chunksize = max(1, len(fasta_paths) // (32 * workers))  # Batch small files to limit inter-process overhead
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for file_rows in executor.map(fasta_qc, fasta_paths, chunksize=chunksize):
+            rows.extend(file_rows)
+    return pd.DataFrame(rows, columns=QC_COLUMNS).astype(
+        {'length': 'Int64', 'longest_n_run': 'Int64', 'invalid_characters': 'Int64'})
+
+
+def qc_passed(qc, min_length=0, max_n_fraction=1.0):
+    """
+    Check the sequences of a QC report against the submission thresholds
+    :param qc: Dataframe of the QC report
+    :param min_length: Minimum sequence length
+    :param max_n_fraction: Maximum fraction of N in a sequence
+    :return: Boolean series, True for sequences which pass
+    """
+    passed = (qc['error'].isna() & (qc['length'] >= min_length) & (qc['n_fraction'] <= max_n_fraction)
+              & (qc['invalid_characters'] == 0))
+    return passed.fillna(False).astype(bool)  # Rows with an error have no statistics to compare
+
+
+def failed_runs(qc, min_length=0, max_n_fraction=1.0):
+    """
+    Obtain the runs with any sequence failing the submission thresholds
+    :param qc: Dataframe of the QC report
+    :param min_length: Minimum sequence length
+    :param max_n_fraction: Maximum fraction of N in a sequence
+    :return: Set of run accessions
+    """
+    return set(qc.loc[~qc_passed(qc, min_length, max_n_fraction), 'run_accession'])
+
+
+if __name__ == '__main__':
+    args = get_args()
+    with open(args.fasta_files) as f:
+        fasta_paths = [line.strip() for line in f if line.strip()]
+    qc = run_qc(fasta_paths, args.workers)
+    qc['PASSED'] = qc_passed(qc, args.min_length, args.max_n_fraction)
+    qc.to_csv(args.output, sep="\t", index=False)
+    failed = failed_runs(qc, args.min_length, args.max_n_fraction)
+    print("number of runs checked: {}, failed: {}".format(qc['run_accession'].nunique(), len(failed)))
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+# Utilities to split the metadata of a project into shards which can be validated and submitted by independent jobs.
+# Rows are ordered by a stable hash of the run accession (or sample accession, keeping the runs of a sample together)
+# and cut into contiguous, balanced shards, each written with its own header and listed in a shard index file.
+# Cluster array tasks given --shard i/N instead each process the runs whose hash falls in their shard, and running
+# this script merges the per-shard outputs into the final metadata file.
+
+import argparse, glob, os, re, shutil, sys, zlib
+import numpy as np
+import pandas as pd
+from fasta_utils import run_accession
+
+SHARD_KEYS = {'run': 'RUN_REF', 'sample': 'SAMPLE'}  # Column the rows are sharded by
+SHARD_PATTERN = re.compile(r'_shard(\d+)of(\d+)$')  # Suffix of the name of a shard file
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  sharding.py                                                          |
+        |  Tool which merges the per-shard metadata files of projects into      |
+        |  the final <project>_Consensus_Metadata.txt files.                    |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('metadata_files', type=str, nargs='+',
+                        help='Final metadata files to merge the shards of (e.g. PRJEB1234_Consensus_Metadata.txt)')
+    parser.add_argument('--allow_missing', action='store_true',
+                        help='Merge the shards found even if some are missing, e.g. shards of array tasks which failed')
+    args = parser.parse_args()
+    return args
+
+
+def stable_hash(values):
+    """
+    Hash values with CRC-32, which unlike hash() is the same in every process and Python version
+    :param values: Iterable of strings
+    :return: NumPy array of the hashes
+    """
+    return np.fromiter((zlib.crc32(str(value).encode()) for value in values), dtype=np.uint32)
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as i/N, where i is from 1 to N (e.g. $SLURM_ARRAY_TASK_ID/N with --array=1-N)
+    :param value: Shard, as i/N
+    :return: Tuple of the shard number and number of shards
+    """
+    match = re.fullmatch(r'(\d+)/(\d+)', value.strip())
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("shard must be given as i/N with 1 <= i <= N, not '{}'".format(value))
+    return int(match.group(1)), int(match.group(2))
+
+
+def in_shard(runs, shard):
+    """
+    Find which runs belong to a shard, by a stable hash of their run accession
+    :param runs: Iterable of run accessions
+    :param shard: Tuple of the shard number (from 1) and number of shards
+    :return: NumPy array of booleans, True for the runs in the shard
+    """
+    number, shards = shard
+    return stable_hash(runs) % shards == number - 1
+
+
+def paths_in_shard(paths, shard):
+    """
+    Keep the paths of the files of the runs in a shard, the run being referred in the name of each file
+    :param paths: Iterable of file paths (e.g. ERR4080473.fasta.gz)
+    :param shard: Tuple of the shard number (from 1) and number of shards
+    :return: List of the file paths in the shard
+    """
+    paths = list(paths)
+    return [path for path, keep in zip(paths, in_shard(map(run_accession, paths), shard)) if keep]
+
+
+def shard_count(rows, shards=None, rows_per_shard=None):
+    """
+    Obtain the number of shards to split rows into
+    :param rows: Number of rows
+    :param shards: Number of shards, if given
+    :param rows_per_shard: Maximum number of rows per shard, if given instead
+    :return: Number of shards, at least 1
+    """
+    if rows_per_shard:
+        return max(1, -(-rows // rows_per_shard))
+    return max(1, shards or 1)
+
+
+def shard_metadata(metadata, shards, by='run'):
+    """
+    Split metadata into balanced shards. Rows are ordered by the hash of their key and cut into shards of equal size,
+    moving each cut to the next change of key so that rows sharing a key (e.g. the runs of a sample) stay together
+    :param metadata: Dataframe of the metadata
+    :param shards: Number of shards
+    :param by: Key to shard by, 'run' or 'sample'
+    :return: List of dataframes, one per shard (some may be empty if there are fewer keys than shards)
+    """
+    keys = metadata[SHARD_KEYS[by]].astype(str).to_numpy()
+    order = np.lexsort((keys, stable_hash(keys)))  # Ties of the hash are broken by the key itself
+    ordered = metadata.iloc[order]
+    ordered_keys = keys[order]
+    cuts = [0]
+    for shard in range(1, shards):
+        cut = max(cuts[-1], round(shard * len(ordered) / shards))
+        while 0 < cut < len(ordered) and ordered_keys[cut] == ordered_keys[cut - 1]:
+            cut += 1
+        cuts.append(cut)
+    cuts.append(len(ordered))
+    return [ordered.iloc[start:end] for start, end in zip(cuts[:-1], cuts[1:])]
+
+
+def shard_filename(metadata_filename, shard, shards):
+    """
+    Obtain the name of the file of a shard
+    :param metadata_filename: Name of the unsharded metadata file (e.g. PRJEB1234_Consensus_Metadata.txt)
+    :param shard: Number of the shard, from 1
+    :param shards: Total number of shards
+    :return: Name of the file of the shard (e.g. PRJEB1234_Consensus_Metadata_shard03of10.txt)
+    """
+    root, extension = os.path.splitext(metadata_filename)
+    width = len(str(shards))
+    return '{}_shard{:0{width}d}of{:0{width}d}{}'.format(root, shard, shards, extension, width=width)
+
+
+def write_shards(metadata, metadata_filename, shards, by='run'):
+    """
+    Write metadata as shards, each with its own header, and a shard index file listing them
+    :param metadata: Dataframe of the metadata
+    :param metadata_filename: Name of the unsharded metadata file
+    :param shards: Number of shards
+    :param by: Key to shard by, 'run' or 'sample'
+    :return: Dataframe of the shard index
+    """
+    index = []
+    for shard, shard_data in enumerate(shard_metadata(metadata, shards, by), 1):
+        filename = shard_filename(metadata_filename, shard, shards)
+        shard_data.to_csv(filename, sep="\t", index=False)
+        index.append((shard, filename, len(shard_data)))
+    index = pd.DataFrame(index, columns=['SHARD', 'FILE', 'ROWS'])
+    index.to_csv(os.path.splitext(metadata_filename)[0] + '_shards.txt', sep="\t", index=False)
+    return index
+
+
+def merge_shards(metadata_filename, allow_missing=False):
+    """
+    Concatenate the per-shard metadata files of a project into the final metadata file, keeping a single header
+    :param metadata_filename: Name of the final metadata file (e.g. PRJEB1234_Consensus_Metadata.txt)
+    :param allow_missing: Whether to merge the shards found if some are missing
+    :return: Number of shard files merged
+    """
+    root, extension = os.path.splitext(metadata_filename)
+    shard_files = {}
+    for path in glob.glob(glob.escape(root) + '_shard*of*' + extension):
+        match = SHARD_PATTERN.search(os.path.splitext(path)[0])
+        if match:
+            shard_files.setdefault(int(match.group(2)), {})[int(match.group(1))] = path
+    if not shard_files:
+        sys.stderr.write("ERROR: No shard files found for {}\n".format(metadata_filename))
+        exit(1)
+    if len(shard_files) > 1:
+        sys.stderr.write("ERROR: Shard files of {} were written for different numbers of shards: {}\n".format(
+            metadata_filename, ', '.join(map(str, sorted(shard_files)))))
+        exit(1)
+    shards, files = next(iter(shard_files.items()))
+    missing = [number for number in range(1, shards + 1) if number not in files]
+    if missing and not allow_missing:
+        sys.stderr.write("ERROR: Shards {} of {} of {} are missing\n".format(
+            ', '.join(map(str, missing)), shards, metadata_filename))
+        exit(1)
+
+    temporary = metadata_filename + '.tmp'
+    header = None
+    with open(temporary, 'w') as merged:
+        for number in sorted(files):
+            with open(files[number]) as f:
+                shard_header = f.readline()
+                if header is None:
+                    header = shard_header
+                    merged.write(header)
+                elif shard_header != header:
+                    sys.stderr.write("ERROR: {} has different columns to the other shards\n".format(files[number]))
+                    exit(1)
+                shutil.copyfileobj(f, merged, length=1024 * 1024)
+    os.replace(temporary, metadata_filename)
+    return len(files)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    for metadata_filename in args.metadata_files:
+        merged = merge_shards(metadata_filename, args.allow_missing)
+        print("{}: merged {} shard files".format(metadata_filename, merged))
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+# Script to split multi-FASTA files of consensus sequences into one gzipped FASTA file per run, named <run>.fasta.gz
+# as expected by create_metadata_spreadsheet.py. Each input is streamed once, one record at a time, and inputs are
+# split in parallel. A list of the files written is created to be passed as -f/--fasta_files.
+
+import argparse, gzip, os, re, sys
+from concurrent.futures import ProcessPoolExecutor
+from fasta_index import IndexedFasta, is_bgzf
+from fasta_utils import format_record, read_records, sequence_name
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  split_multifasta.py                                                  |
+        |  Tool which splits multi-FASTA files of consensus sequences into      |
+        |  one gzipped FASTA file per run.                                      |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('inputs', type=str, nargs='+', help='Multi-FASTA files to split, optionally gzipped')
+    parser.add_argument('-o', '--output_dir', type=str, default='.',
+                        help='Directory to write the per-run FASTA files to (default: current directory)')
+    parser.add_argument('-l', '--list_file', type=str, default='fasta_files.txt',
+                        help='File listing the per-run FASTA files written, to be passed as -f/--fasta_files (default: fasta_files.txt)')
+    parser.add_argument('-r', '--run_regex', type=str,
+                        help='Regular expression whose first group extracts the run from a sequence name (default: the part of the name before the first underscore)')
+    parser.add_argument('--runs', type=str,
+                        help='Only write these runs, e.g. for resubmission. Inputs which are plain or bgzip-compressed are read through a .fai index (built if missing) to seek straight to each record. Format: List of run accessions - one per line')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of input files split at the same time (default: number of CPUs)')
+    parser.add_argument('--compresslevel', type=int, default=6, help='Gzip compression level (default: 6)')
+    args = parser.parse_args()
+    return args
+
+
+def record_run(name, run_regex=None):
+    """
+    Obtain the run a consensus sequence belongs to from its name (e.g. ERR4080473_consensus)
+    :param name: Sequence name
+    :param run_regex: Regular expression whose first group is the run, None to take the part before the first underscore
+    :return: Run accession, or None if the regular expression does not match
+    """
+    if run_regex is None:
+        return name.split('_')[0]
+    match = re.search(run_regex, name)
+    return match.group(1) if match else None
+
+
+def indexed_records(path, runs, run_regex=None):
+    """
+    Read only the records of the given runs from an indexed FASTA file, seeking straight to each of them
+    :param path: Path to the FASTA file, plain or bgzip-compressed
+    :param runs: Set of runs to read
+    :param run_regex: Regular expression whose first group is the run, None to take the part before the first underscore
+    :return: Generator of sequence name and sequence (bytes) tuples
+    """
+    fasta = IndexedFasta(path)
+    try:
+        for name in fasta.names():
+            if record_run(name, run_regex) in runs:
+                yield name, fasta.fetch(name)
+    finally:
+        fasta.close()
+
+
+def split_file(path, output_dir, suffix, run_regex=None, compresslevel=6, runs=None):
+    """
+    Split a multi-FASTA file into one gzipped FASTA file per run. Records of a run already written from this file are
+    appended to its file as a further gzip member
+    :param path: Path to the multi-FASTA file
+    :param output_dir: Directory to write the per-run FASTA files to
+    :param suffix: Suffix added to the per-run file names, so inputs split at the same time never write the same file
+    :param run_regex: Regular expression whose first group is the run, None to take the part before the first underscore
+    :param compresslevel: Gzip compression level
+    :param runs: Set of runs to write, None for all runs
+    :return: List of runs written, in the order first seen, and number of records skipped as their run was not found
+    """
+    if runs is not None and (not path.endswith('.gz') or is_bgzf(path)):
+        records = indexed_records(path, runs, run_regex)  # Headers are reduced to the sequence names held in the index
+    else:
+        records = read_records(path)
+    runs_written, written, skipped = [], set(), 0
+    for header, sequence in records:
+        run = record_run(sequence_name(header), run_regex)
+        if not run:
+            skipped += 1
+            continue
+        if runs is not None and run not in runs:
+            continue
+        mode = 'ab' if run in written else 'wb'
+        with gzip.open(os.path.join(output_dir, run + '.fasta.gz' + suffix), mode, compresslevel=compresslevel) as f:
+            f.write(format_record(header, sequence))
+        if run not in written:
+            written.add(run)
+            runs_written.append(run)
+    return runs_written, skipped
+
+
+if __name__ == '__main__':
+    args = get_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    selected_runs = None
+    if args.runs:
+        with open(args.runs) as f:
+            selected_runs = {line.strip() for line in f if line.strip()}
+
+    seen = {}  # Run to the input it was written from, to detect runs split from more than one input
+    with ProcessPoolExecutor(max_workers=args.workers) as executor, open(args.list_file, 'w') as list_file:
+        futures = [executor.submit(split_file, path, args.output_dir, '.part{}'.format(index), args.run_regex,
+                                   args.compresslevel, selected_runs) for index, path in enumerate(args.inputs)]
+        for index, (path, future) in enumerate(zip(args.inputs, futures)):
+            runs, skipped = future.result()
+            if skipped:
+                sys.stderr.write("WARNING: {} records in {} did not match a run and were skipped\n".format(skipped, path))
+            for run in runs:
+                filename = os.path.join(args.output_dir, run + '.fasta.gz')
+                if run in seen:
+                    sys.stderr.write("WARNING: Run {} found in both {} and {}, only the first is kept\n".format(
+                        run, seen[run], path))
+                    os.remove(filename + '.part{}'.format(index))
+                    continue
+                seen[run] = path
+                os.replace(filename + '.part{}'.format(index), filename)
+                list_file.write(filename + '\n')
+    print("number of per-run FASTA files written: {}".format(len(seen)))
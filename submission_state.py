@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+# Resumable submission state, kept per run (RUN_REF) in a SQLite database: whether the chromosome list, FASTA,
+# manifest, validation and submission of each run are done, and the accession received for the submission. Scripts
+# given the same state database skip the runs already done, so a re-run of a batch only processes the delta.
+
+import argparse, sqlite3
+import pandas as pd
+from datetime import datetime
+from itertools import islice
+
+STEPS = ['chromosome_list', 'fasta', 'manifest', 'validation', 'submission']  # Steps tracked per run
+BATCH_SIZE = 100000  # Rows written per executemany call
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  submission_state.py                                                  |
+        |  Tool which summarises the submission state of the runs recorded      |
+        |  in a state database.                                                 |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('state_db', type=str, help='SQLite submission state database')
+    parser.add_argument('-o', '--output', type=str, help='Also write the state of every run to this file')
+    args = parser.parse_args()
+    return args
+
+
+def batches(items, size=BATCH_SIZE):
+    """
+    Split an iterable into lists of at most size items
+    :param items: Iterable to split
+    :param size: Maximum number of items per list
+    :return: Generator of lists
+    """
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class SubmissionState:
+    # Class object which handles the SQLite database of the submission state of every run
+    def __init__(self, path):
+        self.path = path  # Path to the SQLite database
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")  # Readers are not blocked while a batch is written
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS run_state (
+                run_ref TEXT PRIMARY KEY,
+                {}
+                accession TEXT,
+                updated_at TEXT NOT NULL) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS run_state_accession ON run_state (accession);
+            CREATE TEMP TABLE IF NOT EXISTS lookup_run (run_ref TEXT PRIMARY KEY) WITHOUT ROWID;
+            """.format(''.join('{}_done INTEGER NOT NULL DEFAULT 0,\n'.format(step) for step in STEPS)))
+
+    @staticmethod
+    def column(step):
+        """
+        Obtain the column recording whether a step is done
+        :param step: Step, one of STEPS
+        :return: Column name
+        """
+        if step not in STEPS:
+            raise ValueError("Unknown step '{}', expected one of {}".format(step, ', '.join(STEPS)))
+        return step + '_done'
+
+    def mark_done(self, step, runs):
+        """
+        Record a step as done for runs, in batched transactions
+        :param step: Step, one of STEPS
+        :param runs: Iterable of run accessions
+        """
+        column = self.column(step)
+        updated_at = datetime.now().isoformat(timespec='seconds')
+        query = ("INSERT INTO run_state (run_ref, {0}, updated_at) VALUES (?, 1, ?) "
+                 "ON CONFLICT (run_ref) DO UPDATE SET {0} = 1, updated_at = excluded.updated_at").format(column)
+        for batch in batches(runs):
+            with self.connection:
+                self.connection.executemany(query, ((run, updated_at) for run in batch))
+
+    def record_accessions(self, accessions):
+        """
+        Record the accessions received for submitted runs, marking their submission as done
+        :param accessions: Dictionary of run accession to received accession
+        """
+        updated_at = datetime.now().isoformat(timespec='seconds')
+        query = ("INSERT INTO run_state (run_ref, submission_done, accession, updated_at) VALUES (?, 1, ?, ?) "
+                 "ON CONFLICT (run_ref) DO UPDATE SET submission_done = 1, accession = excluded.accession, "
+                 "updated_at = excluded.updated_at")
+        for batch in batches(accessions.items()):
+            with self.connection:
+                self.connection.executemany(query, ((run, accession, updated_at) for run, accession in batch))
+
+    def done_runs(self, step, runs):
+        """
+        Find which of the runs have a step done, joining them on the primary key through a temporary table rather than
+        querying each run
+        :param step: Step, one of STEPS
+        :param runs: Iterable of run accessions
+        :return: Set of the run accessions with the step done
+        """
+        column = self.column(step)
+        with self.connection:
+            self.connection.execute("DELETE FROM lookup_run")
+            for batch in batches(runs):
+                self.connection.executemany("INSERT OR IGNORE INTO lookup_run VALUES (?)", ((run,) for run in batch))
+        done = {run for run, in self.connection.execute(
+            "SELECT run_ref FROM lookup_run JOIN run_state USING (run_ref) WHERE {} = 1".format(column))}
+        with self.connection:
+            self.connection.execute("DELETE FROM lookup_run")
+        return done
+
+    def pending(self, step, runs):
+        """
+        Keep the runs which do not have a step done yet
+        :param step: Step, one of STEPS
+        :param runs: List of run accessions
+        :return: List of the run accessions without the step done, in the same order
+        """
+        done = self.done_runs(step, runs)
+        return [run for run in runs if run not in done]
+
+    def summary(self):
+        """
+        Count the runs with each step done
+        :return: Dictionary of step to number of runs, plus the total number of runs
+        """
+        row = self.connection.execute("SELECT COUNT(*), {} FROM run_state".format(
+            ', '.join('SUM({})'.format(self.column(step)) for step in STEPS))).fetchone()
+        return dict(zip(['runs'] + STEPS, [value or 0 for value in row]))
+
+    def close(self):
+        """
+        Close the database
+        """
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    state = SubmissionState(args.state_db)
+    for name, count in state.summary().items():
+        print("{}: {}".format(name, count))
+    if args.output:
+        pd.read_sql_query("SELECT * FROM run_state ORDER BY run_ref", state.connection).to_csv(args.output, sep="\t", index=False)
+    state.close()
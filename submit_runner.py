@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+# Script to submit the assemblies of a metadata spreadsheet, writing one Webin-CLI manifest per run and running
+# Webin-CLI (or another command) for each of them through an asyncio subprocess pool with a concurrency cap and a
+# per-job timeout. The exit status of every job is collected in a report.
+
+import argparse, asyncio, os, re, shlex, sys, time
+import pandas as pd
+from submission_state import SubmissionState
+from write_manifests import unique_runs, write_manifests
+
+WEBIN_CLI_COMMAND = ('java -jar {webin_cli} -context genome -manifest {manifest} -inputDir {input_dir} '
+                     '-outputDir {output_dir} -userName {username} -passwordEnv WEBIN_PASSWORD -{mode}')
+REPORT_COLUMNS = ['RUN_REF', 'EXIT_STATUS', 'STATUS', 'DURATION', 'LOG', 'ACCESSION']
+ACCESSION_PATTERN = re.compile(rb'\bERZ\d+\b')  # Analysis accession assigned by Webin-CLI, found in the job log
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  submit_runner.py                                                     |
+        |  Tool which writes a manifest per run of a metadata spreadsheet and   |
+        |  submits the runs with Webin-CLI in parallel.                         |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('spreadsheet', type=str, help='Metadata spreadsheet to submit (<project>_Consensus_Metadata.txt)')
+    parser.add_argument('-i', '--input_dir', type=str, default='.',
+                        help='Directory the FASTA and CHROMOSOME_LIST paths in the spreadsheet are relative to (default: current directory)')
+    parser.add_argument('-m', '--manifest_dir', type=str, default='manifests',
+                        help='Directory to write the manifests to (default: manifests)')
+    parser.add_argument('-o', '--output_dir', type=str, default='submissions',
+                        help='Directory for the Webin-CLI output and job logs (default: submissions)')
+    parser.add_argument('-r', '--report', type=str, default='submission_report.txt',
+                        help='Report of the exit status of every job (default: submission_report.txt)')
+    parser.add_argument('--webin_cli', type=str, default='webin-cli.jar', help='Path to the Webin-CLI jar (default: webin-cli.jar)')
+    parser.add_argument('-u', '--username', type=str, default=os.environ.get('WEBIN_USERNAME'),
+                        help='Webin submission account, the password is read from WEBIN_PASSWORD (default: WEBIN_USERNAME)')
+    parser.add_argument('--mode', type=str, choices=['validate', 'submit'], default='submit',
+                        help='Only validate the assemblies, or submit them (default: submit)')
+    parser.add_argument('--command', type=str, default=WEBIN_CLI_COMMAND,
+                        help='Command run per manifest, with {manifest}, {run}, {input_dir}, {output_dir}, {webin_cli}, '
+                             '{username} and {mode} placeholders (default: Webin-CLI)')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Maximum number of jobs running at the same time (default: 8)')
+    parser.add_argument('-t', '--timeout', type=float, default=3600,
+                        help='Seconds after which a job is killed (default: 3600)')
+    parser.add_argument('--state_db', type=str,
+                        help='SQLite submission state database, so that runs already submitted are skipped and receipts are recorded')
+    args = parser.parse_args()
+    if args.command == WEBIN_CLI_COMMAND and (not args.username or 'WEBIN_PASSWORD' not in os.environ):
+        sys.stderr.write("ERROR: Webin-CLI needs -u/--username (or WEBIN_USERNAME) and WEBIN_PASSWORD to be set.\n")
+        exit(1)
+    if args.jobs < 1:
+        sys.stderr.write("ERROR: -j/--jobs must be at least 1.\n")
+        exit(1)
+    return args
+
+
+def receipt_accession(log_path):
+    """
+    Obtain the accession assigned to a submission from the output of Webin-CLI
+    :param log_path: Path to the log of the job
+    :return: Accession, or None if there is none
+    """
+    with open(log_path, 'rb') as f:
+        match = ACCESSION_PATTERN.search(f.read())
+    return match.group().decode() if match else None
+
+
+async def run_job(run, command, log_path, timeout, semaphore):
+    """
+    Run the command of a run once a slot of the pool is free, killing it if it takes longer than the timeout
+    :param run: Run accession
+    :param command: Command to run (list of arguments)
+    :param log_path: File the output of the command is written to
+    :param timeout: Seconds after which the command is killed
+    :param semaphore: Semaphore capping the number of commands running at the same time
+    :return: Report row of the job
+    """
+    async with semaphore:
+        start = time.monotonic()
+        with open(log_path, 'wb') as log:
+            try:
+                process = await asyncio.create_subprocess_exec(*command, stdout=log, stderr=asyncio.subprocess.STDOUT)
+            except OSError as e:
+                log.write('{}\n'.format(e).encode())
+                return [run, None, 'ERROR', 0.0, log_path, None]
+            try:
+                exit_status = await asyncio.wait_for(process.wait(), timeout)
+                status = 'SUCCESS' if exit_status == 0 else 'FAILED'
+            except asyncio.TimeoutError:
+                process.kill()
+                exit_status = await process.wait()
+                status = 'TIMEOUT'
+        accession = receipt_accession(log_path) if status == 'SUCCESS' else None
+        return [run, exit_status, status, round(time.monotonic() - start, 2), log_path, accession]
+
+
+async def run_jobs(jobs, max_jobs, timeout):
+    """
+    Run the commands of all runs in an asyncio subprocess pool
+    :param jobs: List of (run accession, command, log path) tuples
+    :param max_jobs: Maximum number of commands running at the same time
+    :param timeout: Seconds after which a command is killed
+    :return: List of report rows, in the order of the jobs
+    """
+    semaphore = asyncio.Semaphore(max_jobs)
+    return await asyncio.gather(*(run_job(run, command, log_path, timeout, semaphore) for run, command, log_path in jobs))
+
+
+def submit_spreadsheet(metadata, args, state=None):
+    """
+    Write the manifests of the runs of a spreadsheet and run the command of each of them
+    :param metadata: Dataframe of the spreadsheet
+    :param args: Arguments passed to the script
+    :param state: SubmissionState recording the manifests written, None to not record them
+    :return: Dataframe of the report, one row per run
+    """
+    metadata = unique_runs(metadata)  # Jobs of the same run would share an output directory
+    os.makedirs(args.output_dir, exist_ok=True)
+    template = shlex.split(args.command)
+    manifests = write_manifests(metadata, args.manifest_dir)
+    jobs = []
+    for row, (manifest, _) in zip(metadata.to_dict('records'), manifests):
+        output_dir = os.path.join(args.output_dir, row['RUN_REF'])
+        os.makedirs(output_dir, exist_ok=True)
+        fields = {'manifest': manifest, 'run': row['RUN_REF'], 'input_dir': args.input_dir, 'output_dir': output_dir,
+                  'webin_cli': args.webin_cli, 'username': args.username or '', 'mode': args.mode}
+        jobs.append((row['RUN_REF'], [argument.format(**fields) for argument in template],
+                     os.path.join(output_dir, 'job.log')))
+    if state is not None:
+        state.mark_done('manifest', metadata['RUN_REF'])
+    return pd.DataFrame(asyncio.run(run_jobs(jobs, args.jobs, args.timeout)), columns=REPORT_COLUMNS)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    metadata = pd.read_csv(args.spreadsheet, sep="\t", dtype=str, keep_default_na=False)
+    state = SubmissionState(args.state_db) if args.state_db else None
+    if state is not None:
+        # Skip runs already submitted, e.g. when resuming a batch which was interrupted
+        metadata = metadata[~metadata['RUN_REF'].isin(state.done_runs('submission', metadata['RUN_REF']))]
+    report = submit_spreadsheet(metadata, args, state)
+    if state is not None:
+        succeeded = report[report['STATUS'] == 'SUCCESS']
+        if args.mode == 'submit':
+            state.record_accessions(dict(zip(succeeded['RUN_REF'], succeeded['ACCESSION'])))
+        else:
+            state.mark_done('validation', succeeded['RUN_REF'])
+        state.close()
+    report['EXIT_STATUS'] = report['EXIT_STATUS'].astype('Int64')
+    report.to_csv(args.report, sep="\t", index=False)
+    failed = (report['STATUS'] != 'SUCCESS').sum()
+    print("number of runs submitted: {}, failed: {}".format(len(report), failed))
+    if failed:
+        exit(1)
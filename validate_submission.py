@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+# Script to validate a metadata spreadsheet and the FASTA and chromosome list files it refers to before submission,
+# mirroring the genome checks made by Webin-CLI so that failures are found for a whole batch before any submission.
+# Checks: required spreadsheet fields, gzip integrity, chromosome list format and agreement with the FASTA headers,
+# allowed (IUPAC) characters and minimum sequence length. Runs are validated in a process pool.
+
+import argparse, gzip, os, zlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sequence_qc import fasta_arrays, sequence_stats
+from fasta_utils import sequence_name
+from submission_state import SubmissionState
+
+REQUIRED_FIELDS = ['STUDY', 'SAMPLE', 'RUN_REF', 'ASSEMBLYNAME', 'ASSEMBLY_TYPE', 'COVERAGE', 'PROGRAM', 'PLATFORM',
+                   'MOLECULETYPE', 'FASTA', 'CHROMOSOME_LIST']  # Spreadsheet fields which must be filled in
+CHROMOSOME_TYPES = {'chromosome', 'plasmid', 'linkage group', 'monopartite', 'segmented',
+                    'multipartite'}  # Allowed chromosome types in chromosome list files
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  validate_submission.py                                               |
+        |  Tool which validates a metadata spreadsheet and its FASTA and        |
+        |  chromosome list files before submission.                             |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('spreadsheet', type=str, help='Metadata spreadsheet to validate (<project>_Consensus_Metadata.txt)')
+    parser.add_argument('-i', '--input_dir', type=str, default='.',
+                        help='Directory the FASTA and CHROMOSOME_LIST paths in the spreadsheet are relative to (default: current directory)')
+    parser.add_argument('-o', '--output', type=str, default='validation_report.txt',
+                        help='Validation report to write, one row per run (default: validation_report.txt)')
+    parser.add_argument('--min_length', type=int, default=20, help='Minimum sequence length (default: 20)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of runs validated at the same time (default: number of CPUs)')
+    parser.add_argument('--state_db', type=str,
+                        help='SQLite submission state database, so that runs already validated are skipped and runs which pass are recorded, along with their checked FASTA and chromosome list files')
+    args = parser.parse_args()
+    return args
+
+
+def read_checked(path):
+    """
+    Read a file, decompressing it and verifying its gzip checksums if it ends in .gz
+    :param path: Path to the file
+    :return: Contents of the file (bytes)
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read()  # Reading to the end verifies the CRC and length of every member
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def check_chromosome_list(content):
+    """
+    Check the format of a chromosome list file
+    :param content: Contents of the chromosome list file (bytes)
+    :return: List of object names and list of errors
+    """
+    object_names, errors = [], []
+    for number, line in enumerate(content.decode(errors='replace').splitlines(), 1):
+        fields = [field.strip() for field in line.rstrip('\t').split('\t')]
+        if not any(fields):
+            continue
+        if len(fields) < 3:
+            errors.append('chromosome list line {} has fewer than 3 fields'.format(number))
+            continue
+        object_names.append(fields[0])
+        if fields[2].lower() not in CHROMOSOME_TYPES:
+            errors.append("chromosome list line {} has unknown chromosome type '{}'".format(number, fields[2]))
+    if not object_names:
+        errors.append('chromosome list is empty')
+    elif len(set(object_names)) != len(object_names):
+        errors.append('chromosome list has duplicate object names')
+    return object_names, errors
+
+
+def validate_run(row, input_dir='.', min_length=20):
+    """
+    Validate a single run of the spreadsheet
+    :param row: Dictionary of the spreadsheet fields of the run
+    :param input_dir: Directory the file paths are relative to
+    :param min_length: Minimum sequence length
+    :return: Dictionary of the run, its status and the errors found
+    """
+    errors = ['{} is empty'.format(field) for field in REQUIRED_FIELDS if pd.isna(row.get(field)) or row.get(field) == '']
+    if not pd.isna(row.get('COVERAGE')):
+        try:
+            if float(row['COVERAGE']) <= 0:
+                errors.append('COVERAGE must be positive')
+        except (TypeError, ValueError):
+            errors.append('COVERAGE is not a number')
+
+    sequence_names = None
+    if not pd.isna(row.get('FASTA')):
+        try:
+            data = np.frombuffer(read_checked(os.path.join(input_dir, row['FASTA'])), dtype=np.uint8)
+            sequence_names = []
+            for header, sequence in fasta_arrays(data):
+                name = sequence_name(header)
+                sequence_names.append(name)
+                stats = sequence_stats(sequence)
+                if stats['invalid_characters']:
+                    errors.append("sequence '{}' has {} invalid characters".format(name, stats['invalid_characters']))
+                if stats['length'] < min_length:
+                    errors.append("sequence '{}' is shorter than {} bases".format(name, min_length))
+            if not sequence_names:
+                errors.append('FASTA has no sequences')
+        except (OSError, EOFError, zlib.error, UnicodeDecodeError) as error:
+            errors.append('FASTA could not be read: {}'.format(error))
+
+    if not pd.isna(row.get('CHROMOSOME_LIST')):
+        try:
+            object_names, chromosome_list_errors = check_chromosome_list(
+                read_checked(os.path.join(input_dir, row['CHROMOSOME_LIST'])))
+            errors.extend(chromosome_list_errors)
+            if sequence_names is not None and object_names:
+                missing = sorted(set(object_names) - set(sequence_names))
+                unlisted = sorted(set(sequence_names) - set(object_names))
+                if missing:
+                    errors.append('chromosome list objects not in FASTA: {}'.format(', '.join(missing)))
+                if unlisted:
+                    errors.append('FASTA sequences not in chromosome list: {}'.format(', '.join(unlisted)))
+        except (OSError, EOFError, zlib.error, UnicodeDecodeError) as error:
+            errors.append('CHROMOSOME_LIST could not be read: {}'.format(error))
+
+    return {'RUN_REF': row.get('RUN_REF'), 'ASSEMBLYNAME': row.get('ASSEMBLYNAME'),
+            'STATUS': 'FAIL' if errors else 'PASS', 'ERRORS': '; '.join(errors)}
+
+
+def validate_spreadsheet(metadata, input_dir='.', min_length=20, workers=None):
+    """
+    Validate every run of a metadata spreadsheet in a process pool
+    :param metadata: Dataframe of the metadata spreadsheet
+    :param input_dir: Directory the file paths are relative to
+    :param min_length: Minimum sequence length
+    :param workers: Number of runs validated at the same time (default: number of CPUs)
+    :return: Dataframe of the validation report, one row per run
+    """
+    rows = metadata.to_dict('records')
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(validate_run, rows, [input_dir] * len(rows), [min_length] * len(rows),
+                                    chunksize=max(1, len(rows) // (32 * workers))))
+    return pd.DataFrame(results, columns=['RUN_REF', 'ASSEMBLYNAME', 'STATUS', 'ERRORS'])
+
+
+if __name__ == '__main__':
+    args = get_args()
+    metadata = pd.read_csv(args.spreadsheet, sep="\t", dtype=str)
+    state = SubmissionState(args.state_db) if args.state_db else None
+    if state is not None:
+        metadata = metadata[~metadata['RUN_REF'].isin(state.done_runs('validation', metadata['RUN_REF']))]
+    report = validate_spreadsheet(metadata, args.input_dir, args.min_length, args.workers)
+    if state is not None:
+        passed = report.loc[report['STATUS'] == 'PASS', 'RUN_REF']
+        for step in ['fasta', 'chromosome_list', 'validation']:  # A run passes only if both of its files pass the checks
+            state.mark_done(step, passed)
+        state.close()
+    report.to_csv(args.output, sep="\t", index=False)
+    failed = (report['STATUS'] == 'FAIL').sum()
+    print("number of runs validated: {}, failed: {}".format(len(report), failed))
+    if failed:
+        exit(1)
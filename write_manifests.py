@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+# Script to write one Webin-CLI manifest per run of a metadata spreadsheet, or straight from the merged metadata in
+# create_metadata_spreadsheet.py. Manifests are written in a thread pool, and a manifest is only rewritten if the hash
+# of its content has changed, so re-running over a large batch leaves unchanged manifests (and their mtimes) alone.
+
+import argparse, hashlib, os, sys, threading
+import pandas as pd
+from compress_outputs import parallel_map
+
+MANIFEST_FIELDS = ['STUDY', 'SAMPLE', 'RUN_REF', 'ASSEMBLYNAME', 'COVERAGE', 'PROGRAM', 'PLATFORM', 'MINGAPLENGTH',
+                   'MOLECULETYPE', 'ASSEMBLY_TYPE', 'FASTA', 'CHROMOSOME_LIST']  # Metadata fields in a manifest
+
+
+def get_args():
+    """
+    Get arguments that are passed to the script
+    :return: Arguments
+    """
+    parser = argparse.ArgumentParser(description="""
+        + ===================================================================== +
+        |  write_manifests.py                                                   |
+        |  Tool which writes a Webin-CLI manifest for every run of a metadata   |
+        |  spreadsheet.                                                         |
+        + ===================================================================== +
+        """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('spreadsheets', type=str, nargs='+', help='Metadata spreadsheets (<project>_Consensus_Metadata.txt)')
+    parser.add_argument('-m', '--manifest_dir', type=str, default='manifests',
+                        help='Directory to write the manifests to (default: manifests)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of manifests written at the same time (default: number of CPUs)')
+    args = parser.parse_args()
+    return args
+
+
+def manifest_content(row):
+    """
+    Create the content of the manifest of a run, leaving out empty fields
+    :param row: Dictionary of the metadata fields of the run
+    :return: Content of the manifest (bytes)
+    """
+    return ''.join('{}\t{}\n'.format(field, row[field]) for field in MANIFEST_FIELDS
+                   if pd.notna(row.get(field)) and row.get(field) != '').encode()
+
+
+def manifest_path(run, manifest_dir):
+    """
+    Obtain the path to the manifest of a run
+    :param run: Run accession
+    :param manifest_dir: Directory the manifests are written to
+    :return: Path to the manifest
+    """
+    return os.path.join(manifest_dir, '{}.manifest'.format(run))
+
+
+def write_manifest(row, manifest_dir):
+    """
+    Write the manifest of a run, unless an existing manifest already has the same content hash
+    :param row: Dictionary of the metadata fields of the run
+    :param manifest_dir: Directory to write the manifest to
+    :return: Path to the manifest and whether it was written
+    """
+    path = manifest_path(row['RUN_REF'], manifest_dir)
+    content = manifest_content(row)
+    try:
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(content).digest():
+                return path, False
+    except FileNotFoundError:
+        pass
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())  # Unique to this writer
+    with open(temporary, 'wb') as f:
+        f.write(content)
+    os.replace(temporary, path)  # An interrupted run never leaves a truncated manifest
+    return path, True
+
+
+def unique_runs(metadata):
+    """
+    Keep the first row of each run, as a run can only have one manifest and be submitted once
+    :param metadata: Dataframe of the merged metadata, with the spreadsheet columns
+    :return: Dataframe with one row per RUN_REF
+    """
+    duplicated = metadata['RUN_REF'].duplicated()
+    if duplicated.any():
+        sys.stderr.write("WARNING: {} rows repeat the RUN_REF of an earlier row and are ignored: {}\n".format(
+            duplicated.sum(), ', '.join(sorted(set(metadata.loc[duplicated, 'RUN_REF'])))))
+        metadata = metadata[~duplicated]
+    return metadata
+
+
+def write_manifests(metadata, manifest_dir='manifests', workers=None):
+    """
+    Write the manifests of every run of the metadata in parallel
+    :param metadata: Dataframe of the merged metadata, with the spreadsheet columns
+    :param manifest_dir: Directory to write the manifests to
+    :param workers: Number of manifests written at the same time (default: number of CPUs)
+    :return: List of (path, written) tuples, in the order of the runs (the first row of each run)
+    """
+    metadata = unique_runs(metadata)
+    os.makedirs(manifest_dir, exist_ok=True)
+    return list(parallel_map(lambda row: write_manifest(row, manifest_dir), metadata.to_dict('records'),
+                             workers or os.cpu_count()))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    total, written = 0, 0
+    for spreadsheet in args.spreadsheets:
+        results = write_manifests(pd.read_csv(spreadsheet, sep="\t", dtype=str, keep_default_na=False),
+                                  args.manifest_dir, args.workers)
+        total += len(results)
+        written += sum(changed for _, changed in results)
+    print("number of manifests: {}, written: {}, unchanged: {}".format(total, written, total - written))